@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from watermarker.config import Config
+from watermarker.photo_meta import PhotoMeta
+
+ROOT = Path(__file__).parent.parent
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch: pytest.MonkeyPatch) -> None:
+    # 配置中的字体和 logo 使用相对于仓库根目录的路径
+    monkeypatch.chdir(ROOT)
+    # 处理照片时会按配置修改全局的像素上限
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS)
+
+
+def make_config(layout: dict | None = None, logo: dict | None = None, **base) -> Config:
+    data = {
+        "base": {
+            "font": "fonts/Roboto-Light.ttf",
+            "bold_font": "fonts/Roboto-Bold.ttf",
+            **base,
+        }
+    }
+    if layout is not None:
+        data["layout"] = layout
+    if logo is not None:
+        data["logo"] = logo
+    return Config.model_validate(data)
+
+
+def make_meta(**fields) -> PhotoMeta:
+    values = dict(
+        make="SONY",
+        model="ILCE-7M4",
+        lens_make="",
+        lens_model="FE 35mm F1.4 GM",
+        date=datetime(2024, 5, 1, 12, 30),
+        focal_length="35",
+        focal_length_in_35mm_film="35",
+        f_number="1.4",
+        exposure_time="1/200s",
+        iso="100",
+        orientation="Horizontal (normal)",
+        geo_info="无",
+        width=6000,
+        height=4000,
+    )
+    values.update(fields)
+    return PhotoMeta(**values)
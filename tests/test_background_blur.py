@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw
+
+from watermarker import build_processor_chain
+from watermarker.config import Layout
+from watermarker.image_container import ImageContainer
+
+from .conftest import make_config
+
+
+def render(source: Path, layout: Layout, shadow: bool, quality: int) -> Image.Image:
+    config = make_config(
+        layout={"type": layout.value},
+        shadow={"enable": shadow},
+        background_blur={"quality": quality},
+    )
+    container = ImageContainer(source)
+    try:
+        build_processor_chain(config).process(container)
+        return container.get_watermark_img().copy()
+    finally:
+        container.close()
+
+
+@pytest.mark.parametrize("shadow", [False, True])
+@pytest.mark.parametrize(
+    "layout", [Layout.BACKGROUND_BLUR, Layout.BACKGROUND_BLUR_WHITE_BORDER]
+)
+def test_default_quality_is_close_to_full_resolution_blur(
+    tmp_path: Path, layout: Layout, shadow: bool
+) -> None:
+    # 较小的图片缩小后细节最少，误差最大
+    source = tmp_path / "photo.png"
+    image = Image.linear_gradient("L").resize((1200, 800)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 1200, 100):
+        draw.rectangle((x, 0, x + 50, 800), fill=(200, 40, 40))
+    image.save(source)
+
+    full = render(source, layout, shadow, quality=1000)
+    default = render(source, layout, shadow, quality=8)
+    extrema = ImageChops.difference(full, default).getextrema()
+    assert max(high for _, high in extrema) <= 8
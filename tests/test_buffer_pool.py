@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from watermarker import build_processor_chain, process_one
+from watermarker.buffer_pool import BufferPool, get_buffer_pool
+from watermarker.image_processor import StandardProcessor
+
+from .conftest import make_config
+
+
+def test_pool_is_capped_by_bytes() -> None:
+    # RGB 每个像素占 4 个字节，100x100 的画布占 40000 字节
+    pool = BufferPool(max_buffers=4, max_bytes=100_000)
+    canvases = [pool.acquire("RGB", (100, 100)) for _ in range(3)]
+    for canvas in canvases:
+        pool.release(canvas)
+    assert pool.pooled_bytes == 80_000
+
+    # 超过上限的画布不会保留
+    pool.release(pool.acquire("RGB", (200, 200)))
+    assert pool.pooled_bytes == 80_000
+
+    pool.acquire("RGB", (100, 100))
+    assert pool.get_stats().hits == 1
+    assert pool.pooled_bytes == 40_000
+    pool.clear()
+    assert pool.pooled_bytes == 0
+
+
+def test_failed_render_does_not_keep_canvases(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    source = tmp_path / "photo.jpg"
+    Image.new("RGB", (600, 400), (90, 120, 160)).save(source)
+    output = tmp_path / "output"
+    output.mkdir()
+
+    def fail(*args) -> None:
+        raise RuntimeError("render failed")
+
+    monkeypatch.setattr(StandardProcessor, "render_watermark", fail)
+    chain = build_processor_chain(make_config(white_margin={"enable": True}))
+    pool = get_buffer_pool()
+    for _ in range(5):
+        with pytest.raises(RuntimeError):
+            process_one(chain, source, str(output))
+    # 失败时画布已经归还，缓冲池中没有仍被借出的画布
+    assert pool.get_lent_count() == 0
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import time
+from collections import Counter
+from pathlib import Path
+
+from PIL import Image
+
+from watermarker import process_distributed
+from watermarker.lease_queue import LeaseLostError, LeaseQueue
+
+from .conftest import ROOT, make_config
+
+NODES = 3
+TASKS = 40
+
+
+def claim_node(queue_dir: str, result_file: str, stall: bool) -> None:
+    """
+    只领取和完成任务的节点，记录完成的任务和丢失的租约。
+    stall 为真时领取第一个任务后不再继续，等待被结束
+    """
+    queue = LeaseQueue(queue_dir, lease_timeout=1)
+    queue.populate(f"{i}.jpg" for i in range(TASKS))
+    completed, lost = [], []
+    while not queue.is_finished():
+        with queue.heartbeat():
+            for lease in queue.iter_claims():
+                if stall:
+                    time.sleep(3600)
+                time.sleep(0.01)
+                try:
+                    queue.complete(lease)
+                    completed.append(lease.path)
+                except LeaseLostError:
+                    lost.append(lease.path)
+        queue.reclaim_expired()
+        time.sleep(0.1)
+    Path(result_file).write_text(json.dumps({"completed": completed, "lost": lost}))
+
+
+def render_node(input: str, output: str, queue_dir: str, result_file: str) -> None:
+    os.chdir(ROOT)
+    config = make_config(lease_timeout=5)
+    report = process_distributed(config, input, output, queue_dir, max_workers=1)
+    Path(result_file).write_text(json.dumps({"total": report.total}))
+
+
+def wait_for_lease(queue_dir: Path, pid: int) -> None:
+    leases = queue_dir / "leases"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if leases.exists() and any(f"-{pid}-" in n for n in os.listdir(leases)):
+            return
+        time.sleep(0.01)
+    raise TimeoutError(f"节点 {pid} 没有领取任务")
+
+
+def test_every_task_completes_exactly_once_across_processes(tmp_path: Path) -> None:
+    ctx = multiprocessing.get_context("spawn")
+    queue_dir = tmp_path / "queue"
+    # 第一个节点领取任务后停住，然后被结束，它的租约需要由其他节点收回
+    stalled = ctx.Process(
+        target=claim_node, args=(str(queue_dir), str(tmp_path / "stalled"), True)
+    )
+    stalled.start()
+    wait_for_lease(queue_dir, stalled.pid)
+    nodes = [
+        ctx.Process(
+            target=claim_node,
+            args=(str(queue_dir), str(tmp_path / f"node{i}.json"), False),
+        )
+        for i in range(NODES)
+    ]
+    for node in nodes:
+        node.start()
+    stalled.kill()
+    stalled.join()
+    for node in nodes:
+        node.join(timeout=120)
+        assert node.exitcode == 0
+
+    completed, lost = Counter(), []
+    for i in range(NODES):
+        result = json.loads((tmp_path / f"node{i}.json").read_text())
+        completed.update(result["completed"])
+        lost.extend(result["lost"])
+    # 每个任务只完成一次，续约不及时被其他节点再处理一次的任务以丢失租约的形式报告
+    assert completed == Counter(f"{i}.jpg" for i in range(TASKS))
+    assert set(lost) <= set(completed)
+    queue = LeaseQueue(queue_dir)
+    assert len(os.listdir(queue.done_dir)) == TASKS
+    assert not os.listdir(queue.failed_dir)
+
+
+def test_process_distributed_renders_each_photo_once(tmp_path: Path) -> None:
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    for i in range(6):
+        Image.new("RGB", (300 + i * 10, 200), (i * 40, 80, 120)).save(
+            input_dir / f"{i}.jpg"
+        )
+
+    ctx = multiprocessing.get_context("spawn")
+    nodes = [
+        ctx.Process(
+            target=render_node,
+            args=(
+                str(input_dir),
+                str(output_dir),
+                str(tmp_path / "queue"),
+                str(tmp_path / f"node{i}.json"),
+            ),
+        )
+        for i in range(NODES)
+    ]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join(timeout=300)
+        assert node.exitcode == 0
+
+    totals = [
+        json.loads((tmp_path / f"node{i}.json").read_text())["total"]
+        for i in range(NODES)
+    ]
+    assert sum(totals) == 6
+    assert sorted(os.listdir(output_dir)) == [f"{i}.jpg" for i in range(6)]
+    for name in os.listdir(output_dir):
+        with Image.open(output_dir / name) as image:
+            image.verify()
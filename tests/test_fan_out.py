@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageChops
+
+import watermarker
+from watermarker import prepare_outputs, process_fan_out
+from watermarker.config import Layout, OutputConfig
+from watermarker.image_container import ImageContainer
+
+from .conftest import make_config, make_meta
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    path = tmp_path / "input" / "photo.jpg"
+    path.parent.mkdir()
+    image = Image.linear_gradient("L").resize((1200, 800)).convert("RGB")
+    image.save(path, quality=95)
+    return path
+
+
+@pytest.fixture
+def containers(monkeypatch: pytest.MonkeyPatch) -> list[ImageContainer]:
+    # 记录打开的照片，每张照片只应解码一次
+    opened = []
+
+    def open_container(*args, **kwargs) -> ImageContainer:
+        container = ImageContainer(*args, **kwargs)
+        opened.append(container)
+        return container
+
+    monkeypatch.setattr(watermarker, "ImageContainer", open_container)
+    return opened
+
+
+def test_output_sizes_share_one_decode(
+    tmp_path: Path, source: Path, containers: list[ImageContainer]
+) -> None:
+    config = make_config()
+    config.outputs = [
+        OutputConfig(),
+        OutputConfig(size=600, suffix="_web"),
+        OutputConfig(size=300, format="png", suffix="_thumb"),
+    ]
+    output = tmp_path / "output"
+    chains, output_dirs = prepare_outputs([config], str(output))
+    meta = make_meta(width=1200, height=800)
+    process_fan_out(chains, source, output_dirs, meta)
+
+    assert len(containers) == 1
+    heights = {}
+    for name, width in [
+        ("photo.jpg", 1200),
+        ("photo_web.jpg", 600),
+        ("photo_thumb.png", 300),
+    ]:
+        with Image.open(output / name) as result:
+            # 标准布局只在下方添加水印，宽度就是照片部分的边长
+            assert result.width == width
+            heights[width] = result.height
+    # 每个尺寸的水印都按目标宽度重新绘制，与照片等比例
+    assert heights[600] == pytest.approx(heights[1200] / 2, abs=2)
+    assert heights[300] == pytest.approx(heights[1200] / 4, abs=2)
+
+
+def test_layouts_share_one_decode(
+    tmp_path: Path, source: Path, containers: list[ImageContainer]
+) -> None:
+    layouts = [Layout.STANDARD, Layout.BACKGROUND_BLUR, Layout.SQUARE]
+    configs = [make_config(layout={"type": layout.value}) for layout in layouts]
+    meta = make_meta(width=1200, height=800)
+    output = tmp_path / "output"
+    chains, output_dirs = prepare_outputs(configs, str(output))
+    process_fan_out(chains, source, output_dirs, meta)
+    assert len(containers) == 1
+    assert output_dirs == [str(output / layout.value) for layout in layouts]
+
+    # 共享的基础图片不会被前一个布局修改，结果与单独处理每个布局一致
+    for config, output_dir in zip(configs, output_dirs):
+        single = tmp_path / "single" / config.layout.type.value
+        chains, single_dirs = prepare_outputs([config], str(single))
+        process_fan_out(chains, source, single_dirs, meta)
+        with (
+            Image.open(Path(output_dir, "photo.jpg")) as shared,
+            Image.open(single / "photo.jpg") as expected,
+        ):
+            assert ImageChops.difference(shared, expected).getbbox() is None
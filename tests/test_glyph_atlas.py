@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from watermarker.glyph_atlas import GlyphAtlas
+
+FONTS = ["fonts/Roboto-Light.ttf", "fonts/Roboto-Bold.ttf"]
+# 水印中常见的参数文字，包含需要字距调整的字符对
+TEXTS = [
+    "ILCE-7M4",
+    "FE 35mm F1.4 GM",
+    "35mm f/1.4 1/200s ISO100",
+    "2024-05-01 12:30",
+    "AVAVAV To Wa 1111",
+]
+
+
+def draw_both(font: ImageFont.FreeTypeFont, text: str) -> tuple[Image.Image, ...]:
+    size = (round(font.getlength(text)) + font.size * 2, font.size * 3)
+    origin = (font.size, font.size * 2)
+    expected = Image.new("L", size)
+    ImageDraw.Draw(expected).text(origin, text, fill=255, font=font, anchor="ls")
+    actual = Image.new("L", size)
+    GlyphAtlas(font).draw_text(ImageDraw.Draw(actual), origin, text, 255)
+    return expected, actual
+
+
+@pytest.mark.parametrize("path", FONTS)
+@pytest.mark.parametrize("size", [9, 17, 33, 40, 64, 120])
+def test_atlas_matches_draw_text(path: str, size: int) -> None:
+    font = ImageFont.truetype(path, size)
+    for text in TEXTS:
+        expected, actual = draw_both(font, text)
+        assert ImageChops.difference(expected, actual).getbbox() is None, text
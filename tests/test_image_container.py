@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from watermarker import build_processor_chain
+from watermarker.image_container import ImageContainer
+from watermarker.utils import EXIF_ORIENTATION_TAG
+
+from .conftest import make_config, make_meta
+
+
+def test_blurred_base_is_shared_and_frames_are_not(tmp_path: Path) -> None:
+    source = tmp_path / "photo.jpg"
+    Image.new("RGB", (300, 200), (20, 40, 60)).save(source)
+    container = ImageContainer(source)
+    try:
+        blurred = container.get_blurred_img(10, 0.5)
+        assert container.get_blurred_img(10, 0.5) is blurred
+
+        # 加上边框后的画面与基础图片不同，不能复用基础图片的模糊结果
+        frame = ImageOps.expand(container.get_img(), 20, fill="white")
+        with container.get_blurred_img(10, 0.5, frame) as blurred_frame:
+            assert blurred_frame.size == (170, 120)
+            assert blurred_frame.getpixel((0, 0)) != blurred.getpixel((0, 0))
+        assert container.get_blurred_img(10, 0.5, container.get_img()) is blurred
+    finally:
+        container.close()
+
+
+def test_rotated_photo_is_saved_upright(tmp_path: Path) -> None:
+    # 传感器方向的左半边为红色，顺时针旋转 90 度后位于上方
+    source = tmp_path / "photo.jpg"
+    image = Image.new("RGB", (600, 400), (0, 0, 200))
+    image.paste((200, 0, 0), (0, 0, 300, 400))
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION_TAG] = 6
+    image.save(source, exif=exif)
+
+    meta = make_meta(orientation="Rotate 90 CW", width=600, height=400)
+    target = tmp_path / "output.jpg"
+    with ImageContainer(source, meta=meta) as container:
+        build_processor_chain(make_config()).process(container)
+        container.save(target)
+
+    with Image.open(target) as result:
+        # 像素已经转正，EXIF 中的方向改为正常，查看器不会再次旋转
+        assert result.getexif()[EXIF_ORIENTATION_TAG] == 1
+        assert result.width == 400
+        assert result.getpixel((200, 100))[0] > 150
+        assert result.getpixel((200, 500))[2] > 150
+
+
+def test_average_color_is_computed_once(tmp_path: Path) -> None:
+    source = tmp_path / "photo.png"
+    image = Image.new("RGB", (320, 200), (200, 0, 0))
+    image.paste((0, 0, 100), (160, 0, 320, 200))
+    image.save(source)
+    container = ImageContainer(source)
+    try:
+        assert container.get_average_color() == (100, 0, 50)
+        container.img.paste((0, 0, 0), (0, 0, 320, 200))
+        assert container.get_average_color() == (100, 0, 50)
+        # 缩小后基础图片已变化，重新计算
+        container.shrink(150)
+        assert container.get_average_color() == (0, 0, 0)
+    finally:
+        container.close()
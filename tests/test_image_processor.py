@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageChops
+
+from watermarker import build_processor_chain
+from watermarker.config import Config, Layout
+from watermarker.image_container import ImageContainer
+from watermarker.image_processor import SimpleProcessor, StandardProcessor
+
+from .conftest import make_config
+
+
+def test_disabled_logo_is_not_loaded(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    source = tmp_path / "photo.jpg"
+    Image.new("RGB", (600, 400), (90, 120, 160)).save(source)
+    config = make_config(logo={"enable": False})
+
+    def fail(*args) -> None:
+        raise AssertionError("logo loaded")
+
+    monkeypatch.setattr(Config, "load_logo", fail)
+    monkeypatch.setattr(Config, "load_scaled_logo", fail)
+    container = ImageContainer(source)
+    try:
+        watermark = StandardProcessor(config).render_watermark(container, 600)
+        assert watermark.width == 600
+    finally:
+        container.close()
+
+
+def test_simple_layout_draws_text_into_the_photo(tmp_path: Path) -> None:
+    source = tmp_path / "photo.png"
+    Image.new("RGBA", (600, 400), (90, 120, 160, 255)).save(source)
+    config = make_config(layout={"type": "simple"})
+    container = ImageContainer(source)
+    try:
+        SimpleProcessor(config).process(container)
+        result = container.get_watermark_img()
+        footer = result.crop((0, 400, result.width, result.height))
+        assert result.mode == "RGBA"
+        # 文字边缘与白色背景混合，不会留下半透明的像素
+        assert footer.getchannel("A").getextrema() == (255, 255)
+        assert footer.convert("L").getextrema()[0] < 128
+    finally:
+        container.close()
+
+
+@pytest.mark.parametrize(
+    "layout", [Layout.STANDARD, Layout.SQUARE, Layout.PURE_WHITE_MARGIN]
+)
+def test_planned_chain_matches_sequential_processing(
+    tmp_path: Path, layout: Layout
+) -> None:
+    source = tmp_path / "photo.png"
+    Image.linear_gradient("L").resize((600, 400)).convert("RGB").save(source)
+    config = make_config(
+        layout={"type": layout.value},
+        shadow={"enable": True},
+        white_margin={"enable": True},
+        padding_with_original_ratio={"enable": True},
+    )
+    chain = build_processor_chain(config)
+    results = []
+    for planned in (True, False):
+        container = ImageContainer(source)
+        try:
+            if planned:
+                # 这些组件都只改变几何尺寸，整条链只分配一次最终画布
+                assert chain._plan(container) is not None
+                chain.process(container)
+            else:
+                # 逐个组件处理，每一步都分配新的图片
+                for component in chain.components:
+                    component.process(container)
+            results.append(container.get_watermark_img().copy())
+        finally:
+            container.close()
+    planned_result, sequential_result = results
+    assert planned_result.size == sequential_result.size
+    assert ImageChops.difference(planned_result, sequential_result).getbbox() is None
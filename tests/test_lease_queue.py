@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from watermarker import lease_queue
+from watermarker.lease_queue import LeaseLostError, LeaseQueue
+
+
+def expire(queue: LeaseQueue, name: str) -> None:
+    # 把租约的修改时间改到有效期之前，模拟持有者停止续约
+    old = time.time() - queue.lease_timeout * 2
+    os.utime(queue.leases_dir / name, (old, old))
+
+
+def test_expired_lease_is_reclaimed(tmp_path: Path) -> None:
+    node1 = LeaseQueue(tmp_path, lease_timeout=5)
+    node2 = LeaseQueue(tmp_path, lease_timeout=5)
+    assert node1.populate(["a.jpg", "b.jpg"])
+    lease = node1.claim()
+    expire(node1, lease.name)
+
+    assert node2.reclaim_expired() == 1
+    claimed = [node2.claim(), node2.claim()]
+    assert sorted(c.path for c in claimed) == ["a.jpg", "b.jpg"]
+    with pytest.raises(LeaseLostError):
+        node1.complete(lease)
+    for c in claimed:
+        node2.complete(c)
+    assert node2.is_finished()
+    assert sorted(os.listdir(node2.done_dir)) == ["00000000", "00000001"]
+
+
+def test_released_task_can_be_claimed_again(tmp_path: Path) -> None:
+    node1 = LeaseQueue(tmp_path, lease_timeout=5)
+    node2 = LeaseQueue(tmp_path, lease_timeout=5)
+    node1.populate(["a.jpg"])
+    for _ in range(lease_queue.MAX_ATTEMPTS + 1):
+        # 放回的任务不计入领取次数，不会因为多次放回而被标记为失败
+        node1.release(node1.claim())
+    lease = node2.claim()
+    assert lease.path == "a.jpg"
+    node2.complete(lease)
+    assert node2.is_finished()
+    assert os.listdir(node2.failed_dir) == []
+
+
+def test_lease_renewed_during_reclaim_is_kept(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    node1 = LeaseQueue(tmp_path, lease_timeout=5)
+    node2 = LeaseQueue(tmp_path, lease_timeout=5)
+    node1.populate(["a.jpg"])
+    lease = node1.claim()
+    expire(node1, lease.name)
+
+    rename = os.rename
+
+    def renew_then_rename(src, dst):
+        # 持有者恰好在检查修改时间和移动文件之间续约
+        if Path(src).parent == node1.leases_dir:
+            os.utime(src)
+        rename(src, dst)
+
+    with monkeypatch.context() as m:
+        m.setattr(lease_queue.os, "rename", renew_then_rename)
+        assert node2.reclaim_expired() == 0
+
+    assert node2.claim() is None
+    node1.complete(lease)
+    assert node1.is_finished()
+
+
+def test_stale_reclaim_staging_is_requeued(tmp_path: Path) -> None:
+    node1 = LeaseQueue(tmp_path, lease_timeout=1)
+    node1.populate(["a.jpg"])
+    lease = node1.claim()
+    # 检查租约的节点在移动到暂存目录后退出
+    os.rename(node1.leases_dir / lease.name, node1.reclaim_dir / lease.name)
+    assert not node1.is_finished()
+
+    time.sleep(1.5)
+    node2 = LeaseQueue(tmp_path, lease_timeout=1)
+    assert node2.reclaim_expired() == 1
+    assert node2.claim().path == "a.jpg"
+
+
+def test_populate_takes_over_from_dead_node(tmp_path: Path) -> None:
+    node = LeaseQueue(tmp_path, lease_timeout=5)
+    # 写入任务的节点在完成之前退出，只留下了标记文件和部分任务
+    (tmp_path / "populating").touch()
+    old = time.time() - 10
+    os.utime(tmp_path / "populating", (old, old))
+    (node.tasks_dir / "00000005").write_text("{}")
+
+    assert node.populate(["a.jpg"])
+    assert os.listdir(node.tasks_dir) == ["00000000"]
+    assert LeaseQueue(tmp_path).populate([]) is False
+
+
+def test_populate_stalled_past_timeout_gives_up(tmp_path: Path) -> None:
+    node = LeaseQueue(tmp_path, lease_timeout=5)
+
+    def paths():
+        yield "a.jpg"
+        # 其他节点认为写入的节点已经退出，移走了标记文件
+        os.rename(tmp_path / "populating", node.tmp_dir / "populating.other")
+        (tmp_path / "populating").touch()
+        yield "b.jpg"
+
+    with pytest.raises(LeaseLostError):
+        node.populate(paths())
+    assert not (tmp_path / "ready").exists()
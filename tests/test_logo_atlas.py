@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from watermarker import logo_atlas
+
+
+@pytest.fixture
+def logos(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(logo_atlas, "ATLAS_DIRECTORY", tmp_path / "atlases")
+    monkeypatch.setattr(logo_atlas, "_atlases", {})
+    directory = tmp_path / "logos"
+    directory.mkdir()
+    Image.new("RGBA", (30, 20), (200, 0, 0, 255)).save(directory / "canon.png")
+    return directory
+
+
+def test_directory_is_checked_once_per_process(
+    logos: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    atlas = logo_atlas.load_logo_atlas(logos)
+    assert atlas is not None
+    assert atlas.get("canon.png").getpixel((0, 0)) == (200, 0, 0, 255)
+
+    def fail(directory: Path) -> str:
+        raise AssertionError("signature computed again")
+
+    monkeypatch.setattr(logo_atlas, "get_directory_signature", fail)
+    assert logo_atlas.load_logo_atlas(logos) is atlas
+
+
+def test_refresh_rebuilds_and_closes_the_old_atlas(logos: Path) -> None:
+    atlas = logo_atlas.load_logo_atlas(logos)
+    assert logo_atlas.load_logo_atlas(logos, refresh=True) is atlas
+
+    Image.new("RGBA", (10, 10), (0, 0, 200, 255)).save(logos / "sony.png")
+    refreshed = logo_atlas.load_logo_atlas(logos, refresh=True)
+    assert refreshed is not atlas
+    assert atlas._mmap.closed
+    assert refreshed.get("sony.png").getpixel((0, 0)) == (0, 0, 200, 255)
+    assert [p.name for p in (logos.parent / "atlases").iterdir()] == [
+        refreshed.path.name
+    ]
+
+
+def test_atlas_in_use_is_closed_later(logos: Path) -> None:
+    atlas = logo_atlas.load_logo_atlas(logos)
+    logo = atlas.get("canon.png")
+    Image.new("RGBA", (10, 10)).save(logos / "sony.png")
+    logo_atlas.load_logo_atlas(logos, refresh=True)
+    # 仍被引用的 logo 保持可用
+    assert not atlas._mmap.closed
+    assert logo.getpixel((0, 0)) == (200, 0, 0, 255)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from watermarker import build_processor_chain, process_one
+from watermarker.config import Layout
+from watermarker.image_container import ImageContainer
+
+from .conftest import make_config
+
+
+def make_source(path: Path, mode: str) -> Path:
+    image = Image.linear_gradient("L").resize((600, 400)).convert("RGB")
+    if mode == "RGBA":
+        image.putalpha(128)
+    elif mode == "I;16":
+        image = image.convert("I").point(lambda v: v * 257).convert("I;16")
+    else:
+        image = image.convert(mode)
+    image.save(path)
+    return path
+
+
+@pytest.mark.parametrize(
+    "mode, suffix, expected",
+    [
+        ("RGBA", ".png", "RGBA"),
+        ("CMYK", ".jpg", "CMYK"),
+        ("L", ".jpg", "L"),
+        ("P", ".png", "RGB"),
+        ("I;16", ".png", "L"),
+    ],
+)
+def test_source_mode_is_kept_for_processors(
+    tmp_path: Path, mode: str, suffix: str, expected: str
+) -> None:
+    source = make_source(tmp_path / f"photo{suffix}", mode)
+    container = ImageContainer(source)
+    try:
+        assert container.get_img().mode == expected
+        if mode == "I;16":
+            # 16 位灰度按高 8 位转换，不会被截断为白色
+            assert container.get_img().getextrema() == (0, 255)
+    finally:
+        container.close()
+
+
+@pytest.mark.parametrize("layout", [Layout.PURE_WHITE_MARGIN, Layout.BACKGROUND_BLUR])
+def test_cmyk_photo_keeps_white_colors(tmp_path: Path, layout: Layout) -> None:
+    source = tmp_path / "photo.jpg"
+    Image.new("CMYK", (600, 400), (0, 0, 0, 25)).save(source)
+    output = tmp_path / "output"
+    output.mkdir()
+    config = make_config(layout={"type": layout.value}, white_margin={"enable": True})
+    process_one(build_processor_chain(config), source, str(output))
+    with Image.open(output / "photo.jpg") as result:
+        # 白色边框和混合了白色的背景在 CMYK 照片上不能变成黑色
+        assert result.convert("L").getpixel((1, 1)) > 225
@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+import pickle
+
+from watermarker.photo_meta import META_STRING_MAX_BYTES, PhotoMeta
+
+from .conftest import make_meta
+
+
+def test_round_trip() -> None:
+    meta = make_meta()
+    assert PhotoMeta.from_bytes(meta.to_bytes()) == meta
+    assert pickle.loads(pickle.dumps(meta)) == meta
+
+
+def test_long_string_is_cut_on_a_character_boundary() -> None:
+    # 每个 é 占 2 个字节，上限是奇数，直接截断会留下半个字符
+    meta = make_meta(geo_info="é" * META_STRING_MAX_BYTES)
+    restored = PhotoMeta.from_bytes(meta.to_bytes())
+    assert meta.geo_info.startswith(restored.geo_info)
+    assert len(restored.geo_info.encode("utf-8")) == META_STRING_MAX_BYTES - 1
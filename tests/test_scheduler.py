@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from concurrent.futures import Future
+
+from watermarker.buffer_pool import MAX_POOLED_BYTES
+from watermarker.scheduler import (
+    MIN_BATCH_SIZE,
+    BatchSizer,
+    get_task_budget,
+    iter_batches,
+    run_with_budget,
+)
+
+
+def test_batch_size_has_a_floor() -> None:
+    sizer = BatchSizer(max_size=32)
+    # 每张照片的耗时超过目标时，批次仍然至少包含两张
+    sizer.record(2, 10.0)
+    assert sizer.size == MIN_BATCH_SIZE
+    assert sizer.enabled
+
+
+def test_small_photos_are_not_wrapped_when_batching_is_disabled() -> None:
+    sizer = BatchSizer(max_size=1)
+    assert not sizer.enabled
+    assert list(iter_batches(range(5), lambda item: True, sizer)) == [0, 1, 2, 3, 4]
+
+
+def test_leftover_single_photo_is_submitted_alone() -> None:
+    sizer = BatchSizer(max_size=2)
+    tasks = list(iter_batches([1, 2, 3, 100], lambda item: item < 10, sizer))
+    assert tasks == [(1, 2), 100, 3]
+
+
+def test_skipped_tasks_are_handed_back_without_lookahead() -> None:
+    submitted = []
+    skipped = []
+
+    def submit(item: tuple[str, int]) -> Future:
+        submitted.append(item[0])
+        future = Future()
+        future.set_result(None)
+        return future
+
+    items = [("a", 5), ("b", 5), ("c", 5), ("d", 1), ("e", 1)]
+    run_with_budget(
+        items,
+        submit,
+        lambda item: item[1],
+        budget=6,
+        max_in_flight=4,
+        lookahead=0,
+        on_skip=lambda item: skipped.append(item[0]),
+    )
+    # 放不下的任务立即交还，不会继续向后领取任务
+    assert submitted == ["a", "c", "d"]
+    assert skipped == ["b", "e"]
+
+
+def test_pool_is_reserved_once_per_worker() -> None:
+    assert get_task_budget(None, 4) is None
+    pooled_mb = MAX_POOLED_BYTES // 2**20
+    assert get_task_budget(pooled_mb * 2 + 100, 2) == 100 * 2**20
+    # 预算放不下缓冲池时照片逐张处理
+    assert get_task_budget(pooled_mb, 2) == 0
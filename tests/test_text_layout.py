@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from watermarker.config import load_font
+from watermarker.text_layout import TextBox
+
+
+def test_fitted_text_shares_cached_fonts() -> None:
+    font = load_font("fonts/Roboto-Light.ttf", 240)
+    bold_font = load_font("fonts/Roboto-Bold.ttf", 260)
+    box = TextBox("ILCE-7M4", font, bold_font, is_bold=True)
+    fitted = box.fit(box.height // 2)
+    assert fitted.font is box.fit(box.height // 2).font
+    assert fitted.font is load_font("fonts/Roboto-Bold.ttf", fitted.font.size)
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from watermarker import build_processor_chain, process_one
+from watermarker.image_container import ImageContainer
+from watermarker.image_processor import ProcessorChain
+
+from .conftest import make_config
+
+
+def test_process_over_decompression_bomb_limit_is_tiled(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # 超过 Pillow 默认上限两倍的像素数，默认设置下打开会直接报错
+    size = (20000, 10000)
+    source = tmp_path / "input" / "panorama.jpg"
+    source.parent.mkdir()
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    Image.new("RGB", size, (90, 120, 160)).save(source, quality=80)
+    Image.MAX_IMAGE_PIXELS = limit
+    with pytest.raises(Image.DecompressionBombError):
+        Image.open(source)
+
+    tiled = []
+    process_tiled = ProcessorChain.process_tiled
+
+    def spy(self, container, directory):
+        result = process_tiled(self, container, directory)
+        tiled.append(result)
+        return result
+
+    monkeypatch.setattr(ProcessorChain, "process_tiled", spy)
+    output = tmp_path / "output"
+    output.mkdir()
+    process_one(build_processor_chain(make_config()), source, str(output))
+
+    assert tiled == [True]
+    with Image.open(output / "panorama.jpg") as result:
+        # 标准布局只在下方添加水印
+        assert result.width == size[0]
+        assert result.height > size[1]
+        assert result.getpixel((size[0] // 2, size[1] // 2)) == pytest.approx(
+            (90, 120, 160), abs=3
+        )
+
+
+def test_tiled_buffer_is_closed_with_the_watermark(tmp_path: Path) -> None:
+    source = tmp_path / "photo.jpg"
+    Image.new("RGB", (600, 400), (90, 120, 160)).save(source)
+    container = ImageContainer(source)
+    try:
+        chain = build_processor_chain(make_config())
+        assert chain.process_tiled(container, tmp_path)
+        buffer = container._watermark_buffer
+        assert not buffer.closed
+        container.save(tmp_path / "output.jpg")
+    finally:
+        container.close()
+    assert buffer.closed
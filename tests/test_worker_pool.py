@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from watermarker.scheduler import RemoteTraceback, WorkerExitedError, WorkerPool
+
+
+def double(x: int) -> int:
+    return x * 2
+
+
+def fail(x: int) -> int:
+    raise ValueError(f"bad {x}")
+
+
+def crash(x: int) -> int:
+    os._exit(7)
+
+
+def test_recycled_workers_lose_no_tasks() -> None:
+    with WorkerPool(2, max_tasks_per_worker=2) as pool:
+        futures = [pool.submit(double, i) for i in range(10)]
+        assert [f.result(timeout=60) for f in futures] == [i * 2 for i in range(10)]
+    # 两个工作进程各自的最后一个进程可能只执行了一个任务，不会被回收
+    assert len(pool.recycle_events) >= 4
+    assert all(event.tasks == 2 for event in pool.recycle_events)
+
+
+def test_task_errors_keep_worker_traceback() -> None:
+    with WorkerPool(1) as pool:
+        error = pool.submit(fail, 1).exception(timeout=60)
+    assert isinstance(error, ValueError)
+    assert isinstance(error.__cause__, RemoteTraceback)
+    assert "in fail" in str(error.__cause__)
+
+
+def test_crashed_worker_is_replaced() -> None:
+    with WorkerPool(1) as pool:
+        crashed = pool.submit(crash, 1)
+        after = pool.submit(double, 2)
+        with pytest.raises(WorkerExitedError):
+            crashed.result(timeout=60)
+        assert after.result(timeout=60) == 4
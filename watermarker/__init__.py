@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 import logging
-from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+from concurrent.futures import Future
 from pathlib import Path
+from typing import Iterator, Sequence
 
+from PIL import Image
 from tqdm import tqdm
 
+from .buffer_pool import PoolStats, get_buffer_pool
 from .config import Config, Layout
 from .image_container import ImageContainer
 from .image_processor import (
@@ -15,25 +20,145 @@ from .image_processor import (
     ProcessorChain,
     ShadowProcessor,
 )
-from .utils import get_file_list
+from .lease_queue import POLL_INTERVAL, Lease, LeaseLostError, LeaseQueue
+from .logo_atlas import load_logo_atlas
+from .photo_meta import PhotoMeta
+from .scheduler import (
+    AFFINITY_QUEUE_DEPTH,
+    MAX_WORKERS,
+    BatchSizer,
+    RunReport,
+    WorkerPool,
+    assign_lanes,
+    attach_traceback,
+    estimate_task_memory,
+    get_task_budget,
+    interleave_groups,
+    iter_batches,
+    read_image_size,
+    read_image_sizes,
+    run_with_budget,
+    simulate_makespan,
+)
+from .utils import JPEG_SUFFIXES, get_file_list
 
 logger = logging.getLogger(__name__)
 
 
 def process_one(processor_chain: ProcessorChain, image_file: Path, output: str) -> None:
-    config = processor_chain.config
-    # 打开图片
-    with ImageContainer(image_file) as container:
-        # 使用等效焦距
-        container.is_use_equivalent_focal_length(
-            config.base.focal_length.use_equivalent_focal_length
-        )
+    process_fan_out([processor_chain], image_file, [output])
+
+
+def process_fan_out(
+    processor_chains: Sequence[ProcessorChain],
+    image_file: Path,
+    outputs: Sequence[str],
+    meta: PhotoMeta | None = None,
+) -> PoolStats:
+    """
+    对同一张照片执行多个处理器链，照片只解码一次，元数据只读取一次
+    :param processor_chains: 处理器链列表，每个布局一个
+    :param image_file: 照片路径
+    :param outputs: 每个处理器链对应的输出目录
+    :param meta: 已读取的元数据，为空时在子进程中读取
+    :return: 处理这张照片时画布缓冲池的命中情况
+    """
+    pool_stats = get_buffer_pool().get_stats()
+    tasks = [
+        (processor_chain, output_config, output)
+        for processor_chain, output in zip(processor_chains, outputs)
+        for output_config in processor_chain.config.get_outputs()
+    ]
+    # 按尺寸从大到小排列，同一尺寸的所有布局共享同一张基础图片
+    tasks.sort(key=lambda task: task[1].size or float("inf"), reverse=True)
+    current_size = tasks[0][1].size
+    # 全景图等超大图片超过 Pillow 默认的像素上限，按配置放宽
+    Image.MAX_IMAGE_PIXELS = processor_chains[0].config.base.max_image_pixels
+    # 打开图片，按最大的输出尺寸解码
+    with ImageContainer(image_file, max_size=current_size, meta=meta) as container:
+        for processor_chain, output_config, output in tasks:
+            config = processor_chain.config
+            # 丢弃上一次的结果，由上一级尺寸继续缩小，水印在每个尺寸下重新绘制
+            container.reset_watermark_img()
+            if output_config.size is not None and output_config.size != current_size:
+                container.shrink(output_config.size)
+                current_size = output_config.size
+            # 使用等效焦距
+            container.is_use_equivalent_focal_length(
+                config.base.focal_length.use_equivalent_focal_length
+            )
+            target_path = Path(output).joinpath(output_config.get_filename(image_file))
+            # 处理图片，超大的图片按行分块处理
+            if not (
+                should_process_tiled(container, config, target_path)
+                and processor_chain.process_tiled(container, target_path.parent)
+            ):
+                processor_chain.process(container)
+            # 保存图片
+            container.save(target_path, quality=output_config.quality)
+    return get_buffer_pool().get_stats() - pool_stats
+
+
+# 工作进程中的处理器链，由 init_worker 构建，进程内的所有任务共享配置中缓存的 logo
+_worker_chains: list[ProcessorChain] = []
 
-        # 处理图片
-        processor_chain.process(container)
-        # 保存图片
-        target_path = Path(output).joinpath(image_file.name)
-        container.save(target_path, quality=config.base.quality)
+
+def init_worker(configs: Sequence[Config]) -> None:
+    """
+    工作进程启动时构建处理器链，预先加载图片插件和 logo 图集，
+    回收后重新启动的进程不需要在第一个任务中加载
+    :param configs: 配置列表
+    """
+    Image.init()
+    for config in configs:
+        if config.logo.enable:
+            load_logo_atlas(config.logo.directory)
+    _worker_chains[:] = [build_processor_chain(config) for config in configs]
+
+
+def process_in_worker(
+    image_file: Path, outputs: Sequence[str], meta: PhotoMeta | None = None
+) -> PoolStats:
+    """
+    在工作进程中使用 init_worker 构建的处理器链处理照片，参见 process_fan_out
+    """
+    return process_fan_out(_worker_chains, image_file, outputs, meta)
+
+
+def process_batch_in_worker(
+    image_files: Sequence[Path],
+    outputs: Sequence[str],
+    metas: Sequence[PhotoMeta | None],
+) -> tuple[list[PoolStats | Exception], float]:
+    """
+    在工作进程中依次处理一批小图，单张照片出错不影响同一批次的其他照片
+    :param image_files: 照片路径列表
+    :param outputs: 每个处理器链对应的输出目录
+    :param metas: 每张照片已读取的元数据
+    :return: (每张照片的结果或异常, 处理这一批的耗时)
+    """
+    start = time.perf_counter()
+    results = []
+    for image_file, meta in zip(image_files, metas):
+        try:
+            results.append(process_in_worker(image_file, outputs, meta))
+        except Exception as e:
+            # 与单独提交时一样，异常连同调用栈交给主进程记录
+            results.append(attach_traceback(e))
+    return results, time.perf_counter() - start
+
+
+def should_process_tiled(
+    container: ImageContainer, config: Config, target_path: Path
+) -> bool:
+    """
+    是否对照片使用分块处理：像素数达到阈值，且输出为 JPEG
+    """
+    threshold = config.base.tile_threshold
+    if threshold is None or target_path.suffix.lower() not in JPEG_SUFFIXES:
+        return False
+    width, height = container.get_size()
+    return width * height >= threshold
 
 
 def build_processor_chain(config: Config) -> ProcessorChain:
@@ -61,29 +186,288 @@ def build_processor_chain(config: Config) -> ProcessorChain:
     return processor_chain
 
 
-def process(config: Config, input: str, output: str):
+def get_layout_output_dirs(configs: Sequence[Config], output: str) -> list[str]:
+    """
+    获取每个布局的输出目录，多个布局时按布局类型分别输出到子目录
+    :param configs: 配置列表
+    :param output: 输出目录
+    :return: 输出目录列表
+    """
+    if len(configs) == 1:
+        return [output]
+    output_dirs = []
+    for config in configs:
+        name = config.layout.type.value
+        index = 1
+        while str(Path(output, name)) in output_dirs:
+            index += 1
+            name = f"{config.layout.type.value}-{index}"
+        output_dirs.append(str(Path(output, name)))
+    return output_dirs
+
+
+def prepare_outputs(
+    configs: Sequence[Config], output: str
+) -> tuple[list[ProcessorChain], list[str]]:
+    """
+    构建处理器链并创建输出目录
+    :param configs: 配置列表
+    :param output: 输出目录
+    :return: (每个配置的处理器链, 每个配置的输出目录)
+    """
+    processor_chains = [build_processor_chain(c) for c in configs]
+    output_dirs = get_layout_output_dirs(configs, output)
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+    # 在主进程中预先构建 logo 图集，子进程只需要映射文件。每次处理前重新检查目录，
+    # logo 文件变化后重新构建
+    for c in configs:
+        if c.logo.enable:
+            load_logo_atlas(c.logo.directory, refresh=True)
+    return processor_chains, output_dirs
+
+
+def create_worker_pool(
+    configs: Sequence[Config], max_workers: int = MAX_WORKERS
+) -> WorkerPool:
+    """
+    按配置创建工作进程池
+    """
+    base = configs[0].base
+    return WorkerPool(
+        max_workers,
+        initializer=init_worker,
+        initargs=(configs,),
+        max_tasks_per_worker=base.worker_max_tasks,
+        max_worker_rss=base.worker_max_rss_mb and base.worker_max_rss_mb * 2**20,
+    )
+
+
+def process(config: Config | Sequence[Config], input: str, output: str) -> RunReport:
     """
     状态100：处理图片
-    :return:
+    :param config: 配置，传入多个配置时每张照片只解码一次，依次输出每个布局
+    :return: 处理结果汇总
     """
+    configs = [config] if isinstance(config, Config) else list(config)
+    # 主进程也需要读取文件头，先按配置设置像素上限
+    Image.MAX_IMAGE_PIXELS = configs[0].base.max_image_pixels
     file_list = get_file_list(input)
     logger.info("当前共有 {} 张图片待处理".format(len(file_list)))
 
-    def update(*a):
+    report = RunReport(total=len(file_list))
+
+    def update(task, future):
         # 这个函数将会在每个进程完成后被调用，用来更新进度条
-        pbar.update()
+        image_files = task if isinstance(task, tuple) else (task,)
+        pbar.update(len(image_files))
+        error = future.exception()
+        if error is not None:
+            results = [error] * len(image_files)
+        elif isinstance(task, tuple):
+            results, elapsed = future.result()
+            sizer.record(len(task), elapsed)
+        else:
+            results = [future.result()]
+        for image_file, result in zip(image_files, results):
+            if isinstance(result, Exception):
+                report.failed += 1
+                logger.error(f"处理失败：{image_file} : {result}", exc_info=result)
+            else:
+                report.pool_stats += result
+
+    processor_chains, output_dirs = prepare_outputs(configs, output)
+    base = configs[0].base
+    start = time.perf_counter()
+    metas: dict[Path, PhotoMeta] = {}
+    lanes: dict[Path, int] = {}
+    if base.camera_affinity:
+        # 预先批量读取元数据，其中已经包含照片尺寸
+        metas = PhotoMeta.read_many(file_list)
+        sizes = {f: (meta.width, meta.height) for f, meta in metas.items()}
+    elif base.largest_first or base.memory_budget_mb or base.batch_pixels:
+        # 排序、内存预算和合并批次共用同一次读取的尺寸，每个文件头只打开一次
+        sizes = read_image_sizes(file_list)
+    else:
+        sizes = {}
 
-    processor_chain = build_processor_chain(config)
+    def get_pixels(image_file: Path) -> int:
+        width, height = sizes.get(image_file, (0, 0))
+        return width * height
+
+    if base.largest_first:
+        # 先提交最大的照片，避免最后剩下一张超大照片时其他工作进程空闲
+        report.fifo_makespan = simulate_makespan(map(get_pixels, file_list))
+        file_list = sorted(file_list, key=get_pixels, reverse=True)
+    if base.camera_affinity:
+        # 同一相机和镜头的照片交给同一个工作进程，
+        # 轮流提交各个进程的照片，使每个工作进程都有自己的任务
+        lanes = assign_lanes(
+            file_list,
+            lambda f: metas[f].camera_key if f in metas else None,
+            weight=get_pixels,
+        )
+        file_list = interleave_groups(file_list, lanes.__getitem__)
+        report.affinity_groups = len({meta.camera_key for meta in metas.values()})
+    if base.largest_first:
+        report.planned_makespan = simulate_makespan(map(get_pixels, file_list))
+
+    # 小图的固定开销占比较大，合并成批次提交，大图仍然单独提交
+    def is_small(image_file: Path) -> bool:
+        return (
+            base.batch_pixels is not None
+            and image_file in sizes
+            and get_pixels(image_file) <= base.batch_pixels
+        )
+
+    # 每个工作进程至少分到两批，避免最后只剩一个进程在处理大批次
+    sizer = BatchSizer(sum(map(is_small, file_list)) // (MAX_WORKERS * 2))
+    tasks = iter_batches(file_list, is_small, sizer, key=lanes.get if lanes else None)
+
+    def submit(task: Path | tuple[Path, ...]) -> Future:
+        if isinstance(task, tuple):
+            report.batches += 1
+            report.batched_items += len(task)
+            return pool.submit(
+                process_batch_in_worker,
+                task,
+                output_dirs,
+                [metas.get(f) for f in task],
+                affinity=lanes.get(task[0]),
+            )
+        return pool.submit(
+            process_in_worker,
+            task,
+            output_dirs,
+            metas.get(task),
+            affinity=lanes.get(task),
+        )
+
+    def estimate(task: Path | tuple[Path, ...]) -> int:
+        # 批次中的照片依次处理，峰值内存取决于最大的一张
+        image_files = task if isinstance(task, tuple) else (task,)
+        return max(
+            estimate_task_memory(processor_chains, sizes.get(f)) for f in image_files
+        )
 
     # 初始化tqdm进度条
     pbar = tqdm(total=len(file_list))
 
-    # 设置进程池，最大进程数为5
-    with ProcessPoolExecutor(5) as executor:
-        for source_path in file_list:
-            executor.submit(
-                process_one, processor_chain, source_path, output
-            ).add_done_callback(update)
+    # 设置进程池，按内存预算提交任务，预算允许时最多同时处理 5 张照片
+    with create_worker_pool(configs) as pool:
+        last_submitted = run_with_budget(
+            tasks,
+            submit,
+            estimate,
+            get_task_budget(base.memory_budget_mb, MAX_WORKERS),
+            # 按分组调度时每个工作进程都需要排队的任务，空闲时才能取到自己分组的任务
+            max_in_flight=MAX_WORKERS * AFFINITY_QUEUE_DEPTH if lanes else MAX_WORKERS,
+            on_done=update,
+        )
+    report.elapsed = time.perf_counter() - start
+    report.tail = time.perf_counter() - last_submitted
+    report.recycle_events = pool.recycle_events
+    report.stolen_tasks = pool.stolen_tasks
 
     # 完成所有任务后，关闭tqdm进度条
     pbar.close()
+    report.log()
+    return report
+
+
+def process_distributed(
+    config: Config | Sequence[Config],
+    input: str,
+    output: str,
+    queue_dir: str,
+    max_workers: int = MAX_WORKERS,
+) -> RunReport:
+    """
+    多台机器共同处理同一批照片：每个节点挂载相同的输入、输出和队列目录后调用这个函数，
+    通过队列目录中的租约文件领取照片，每张照片只由一个节点处理。
+    节点意外退出后，它没有完成的照片会在租约过期后由其他节点处理。
+    每一批照片需要使用一个新的队列目录
+    :param config: 配置，所有节点需要使用相同的配置
+    :param queue_dir: 共享的队列目录
+    :param max_workers: 当前节点的工作进程数量
+    :return: 当前节点的处理结果汇总
+    """
+    configs = [config] if isinstance(config, Config) else list(config)
+    base = configs[0].base
+    # 主进程也需要读取文件头，先按配置设置像素上限
+    Image.MAX_IMAGE_PIXELS = base.max_image_pixels
+    input_dir = Path(input)
+    queue = LeaseQueue(queue_dir, lease_timeout=base.lease_timeout)
+
+    def ordered_paths() -> Iterator[str]:
+        # 只有第一个节点会写入任务，按像素数从大到小排列
+        file_list = get_file_list(input)
+        if base.largest_first:
+            sizes = read_image_sizes(file_list)
+            file_list = sorted(
+                file_list,
+                key=lambda f: sizes[f][0] * sizes[f][1] if f in sizes else 0,
+                reverse=True,
+            )
+        for image_file in file_list:
+            yield image_file.relative_to(input_dir).as_posix()
+
+    if queue.populate(ordered_paths()):
+        logger.info(f"已将 {len(os.listdir(queue.tasks_dir))} 张图片写入任务队列")
+
+    processor_chains, output_dirs = prepare_outputs(configs, output)
+    report = RunReport()
+
+    def update(lease: Lease, future: Future) -> None:
+        pbar.update()
+        report.total += 1
+        error = future.exception()
+        try:
+            if error is None:
+                report.pool_stats += future.result()
+                queue.complete(lease)
+            else:
+                report.failed += 1
+                logger.error(f"处理失败：{lease.path} : {error}", exc_info=error)
+                queue.fail(lease, error)
+        except LeaseLostError as e:
+            logger.warning(f"{e}，这张照片可能会被处理两次")
+
+    def release(lease: Lease) -> None:
+        # 内存预算放不下的任务立即放回队列，由有空闲内存的节点领取
+        try:
+            queue.release(lease)
+        except LeaseLostError as e:
+            logger.warning(str(e))
+
+    pbar = tqdm()
+    start = time.perf_counter()
+    with create_worker_pool(configs, max_workers) as pool, queue.heartbeat():
+        while True:
+            # 只在有空闲的工作进程时才领取任务，其他节点可以领取剩下的任务。
+            # 领取到的任务放不下时不再继续领取，并把它放回队列
+            run_with_budget(
+                queue.iter_claims(),
+                lambda lease: pool.submit(
+                    process_in_worker, input_dir / lease.path, output_dirs
+                ),
+                lambda lease: estimate_task_memory(
+                    processor_chains, read_image_size(input_dir / lease.path)
+                ),
+                get_task_budget(base.memory_budget_mb, max_workers),
+                max_in_flight=max_workers,
+                on_done=update,
+                lookahead=0,
+                on_skip=release,
+            )
+            # 其他节点仍在处理时等待，收回它们过期的租约后继续处理
+            queue.reclaim_expired()
+            if queue.is_finished():
+                break
+            time.sleep(POLL_INTERVAL)
+    report.elapsed = time.perf_counter() - start
+    report.recycle_events = pool.recycle_events
+
+    pbar.close()
+    report.log()
+    return report
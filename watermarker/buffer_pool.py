@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import functools
+import weakref
+from collections import deque
+from dataclasses import dataclass
+
+from PIL import Image
+
+# 每个进程中最多保留的空闲画布数量，尺寸不同的照片较多时旧的画布会被释放
+MAX_POOLED_BUFFERS = 4
+# 每个进程中空闲画布占用内存的上限（字节），超过时先释放最早归还的画布，
+# 单张超过上限的画布不会保留
+MAX_POOLED_BYTES = 256 * 2**20
+
+
+def get_image_bytes(image: Image.Image) -> int:
+    """
+    估算图片像素占用的内存：Pillow 中 8 位单通道图片每个像素占 1 个字节，
+    16 位单通道图片占 2 个字节，其他模式（包括 RGB）占 4 个字节
+    """
+    if image.mode in ("1", "L", "P"):
+        pixel_size = 1
+    elif image.mode.startswith("I;16"):
+        pixel_size = 2
+    else:
+        pixel_size = 4
+    return image.width * image.height * pixel_size
+
+
+@functools.lru_cache(maxsize=32)
+def _to_cmyk(color) -> tuple[int, ...]:
+    with Image.new("RGB", (1, 1), color) as pixel, pixel.convert("CMYK") as cmyk:
+        return cmyk.getpixel((0, 0))
+
+
+def get_color(color, mode: str):
+    """
+    将颜色转换为指定模式下的填充值。Pillow 把 RGB 颜色按分量直接填入 CMYK 图片，
+    白色会变成黑色，所以 CMYK 图片的颜色先按 RGB 解析再转换
+    :param color: 颜色名、十六进制颜色或 RGB 元组
+    :param mode: 图片模式
+    :return: 填充值
+    """
+    if mode != "CMYK" or isinstance(color, int):
+        return color
+    if isinstance(color, tuple) and len(color) == 4:
+        # 已经是 CMYK 颜色
+        return color
+    return _to_cmyk(color)
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    """
+    画布缓冲池的命中次数和未命中次数
+    """
+
+    hits: int = 0
+    misses: int = 0
+
+    def __add__(self, other: PoolStats) -> PoolStats:
+        return PoolStats(self.hits + other.hits, self.misses + other.misses)
+
+    def __sub__(self, other: PoolStats) -> PoolStats:
+        return PoolStats(self.hits - other.hits, self.misses - other.misses)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class BufferPool:
+    """
+    按 (模式, 尺寸) 复用全尺寸画布。同一台相机拍摄的照片尺寸相同，
+    处理下一张照片时直接清空上一张照片用过的画布，不再重新分配内存。
+    空闲画布的数量和占用的内存都有上限
+    """
+
+    def __init__(
+        self, max_buffers: int = MAX_POOLED_BUFFERS, max_bytes: int = MAX_POOLED_BYTES
+    ):
+        self.max_buffers = max_buffers
+        self.max_bytes = max_bytes
+        self._free: deque[tuple[tuple[str, tuple[int, int]], Image.Image]] = deque()
+        # 空闲画布占用的内存
+        self.pooled_bytes = 0
+        # 已借出的画布，键为 id。只保留弱引用，处理失败时没有归还的画布
+        # 随异常一起释放，不会一直占用工作进程的内存
+        self._lent: weakref.WeakValueDictionary[int, Image.Image] = (
+            weakref.WeakValueDictionary()
+        )
+        self._hits = 0
+        self._misses = 0
+
+    def acquire(self, mode: str, size: tuple[int, int], color=0) -> Image.Image:
+        """
+        获取一张填充为指定颜色的画布，用完后需要通过 release 归还
+        :param mode: 图片模式
+        :param size: 图片尺寸
+        :param color: 填充颜色
+        :return: 画布
+        """
+        key = (mode, tuple(size))
+        color = get_color(color, mode)
+        for i, (free_key, image) in enumerate(self._free):
+            if free_key == key:
+                del self._free[i]
+                self.pooled_bytes -= get_image_bytes(image)
+                image.paste(color, (0, 0, *size))
+                self._hits += 1
+                break
+        else:
+            image = Image.new(mode, size, color=color)
+            self._misses += 1
+        self._lent[id(image)] = image
+        return image
+
+    def release(self, image: Image.Image) -> None:
+        """
+        归还画布，不是从缓冲池借出的图片直接关闭
+        """
+        size = get_image_bytes(image)
+        if self._lent.pop(id(image), None) is None or size > self.max_bytes:
+            image.close()
+            return
+        self._free.append(((image.mode, image.size), image))
+        self.pooled_bytes += size
+        while len(self._free) > self.max_buffers or self.pooled_bytes > self.max_bytes:
+            _, oldest = self._free.popleft()
+            self.pooled_bytes -= get_image_bytes(oldest)
+            oldest.close()
+
+    def clear(self) -> None:
+        """
+        释放所有空闲画布
+        """
+        while self._free:
+            self._free.popleft()[1].close()
+        self.pooled_bytes = 0
+
+    def get_lent_count(self) -> int:
+        """
+        已借出还没有归还的画布数量
+        """
+        return len(self._lent)
+
+    def is_pooled(self, image: Image.Image) -> bool:
+        """
+        图片是否是缓冲池中空闲的画布
+        """
+        return any(pooled is image for _, pooled in self._free)
+
+    def get_stats(self) -> PoolStats:
+        return PoolStats(self._hits, self._misses)
+
+
+# 每个进程中的画布缓冲池
+_pool = BufferPool()
+
+
+def get_buffer_pool() -> BufferPool:
+    return _pool
+
+
+def new_canvas(mode: str, size: tuple[int, int], color=0) -> Image.Image:
+    """
+    从当前进程的缓冲池中获取画布，代替 Image.new 创建全尺寸图片
+    """
+    return _pool.acquire(mode, size, color)
+
+
+def release_canvas(image: Image.Image) -> None:
+    """
+    释放图片，从缓冲池获取的画布归还到缓冲池，其他图片直接关闭
+    """
+    _pool.release(image)
@@ -1,4 +1,5 @@
 import enum
+import functools
 from pathlib import Path
 from typing import Annotated, Literal
 
@@ -12,6 +13,9 @@ from pydantic import (
 )
 
 from .constants import DATE_VALUE, LENS_VALUE, MODEL_VALUE, PARAM_VALUE
+from .logo_atlas import load_logo_atlas
+
+MAX_SCALED_LOGOS = 16
 
 
 def _validate_hex_color(value: str) -> str:
@@ -43,16 +47,45 @@ class WhiteMarginConfig(SwitchConfig):
     width: Annotated[int, AfterValidator(_fix_width)] = 3
 
 
+class BackgroundBlurConfig(BaseModel):
+    # 缩小后进行模糊时的模糊半径，越大越接近全尺寸模糊，速度越慢。缩小后的图片长边
+    # 不小于 1024 像素，默认值下与全尺寸模糊相比最大相差约 7 级（0-255），平均不到 0.3
+    quality: PositiveInt = 8
+
+
 class BaseConfig(BaseModel):
     bold_font: str = "./fonts/AlibabaPuHuiTi-2-85-Bold.otf"
     font: str = "./fonts/AlibabaPuHuiTi-2-45-Light.otf"
     bold_font_size: PositiveInt = 1
     font_size: PositiveInt = 1
     quality: PositiveInt = 100
+    # 输出图片中照片部分的最大边长，为空时保持原始尺寸
+    max_size: PositiveInt | None = None
+    # 照片像素数不小于该值时分块处理，只支持几何布局和 JPEG 输出，为空时不分块
+    tile_threshold: PositiveInt | None = 100_000_000
+    # 允许解码的最大像素数，超过时 Pillow 拒绝打开，为空时不限制
+    max_image_pixels: PositiveInt | None = 1_000_000_000
+    # 同时处理的照片估算内存之和的上限（MB），为空时不限制
+    memory_budget_mb: PositiveInt | None = None
+    # 工作进程完成指定数量的任务后退出并由新进程代替，为空时不限制
+    worker_max_tasks: PositiveInt | None = None
+    # 工作进程完成任务后常驻内存超过该值（MB）时退出并由新进程代替，为空时不限制
+    worker_max_rss_mb: PositiveInt | None = None
+    # 是否预先读取元数据，把同一相机和镜头的照片交给同一个工作进程，
+    # 提高进程内缓存的命中率
+    camera_affinity: bool = False
+    # 是否按像素数从大到小提交照片，缩短最后只剩少数大照片时的等待
+    largest_first: bool = True
+    # 像素数不超过该值的照片合并成批次提交，分摊进程间通信的开销，为空时不合并
+    batch_pixels: PositiveInt | None = 1_000_000
+    # 多节点处理时租约的有效期（秒），节点超过这个时间没有续约时，
+    # 其他节点会重新处理它的照片
+    lease_timeout: PositiveInt = 60
     focal_length: FocalLengthConfig = Field(default_factory=FocalLengthConfig)
     padding_with_original_ratio: SwitchConfig = Field(default_factory=SwitchConfig)
     shadow: SwitchConfig = Field(default_factory=SwitchConfig)
     white_margin: WhiteMarginConfig = Field(default_factory=WhiteMarginConfig)
+    background_blur: BackgroundBlurConfig = Field(default_factory=BackgroundBlurConfig)
 
 
 class Element(BaseModel):
@@ -92,6 +125,10 @@ class LayoutConfig(BaseModel):
     background_color: HexColor = "#ffffff"
     elements: Elements = Field(default_factory=Elements)
     type: Layout = Layout.STANDARD
+    # 按照输出尺寸缩放字号和间距后直接绘制水印，关闭时先在固定尺寸上绘制再缩放
+    render_at_target_size: bool = True
+    # 使用字形图集绘制水印文字，大批量处理时减少 FreeType 光栅化的开销
+    use_glyph_atlas: bool = False
 
 
 class LogoConfig(BaseModel):
@@ -101,14 +138,35 @@ class LogoConfig(BaseModel):
     position: Literal["left", "right"] = "left"
 
 
+OUTPUT_FORMAT_SUFFIXES = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+
+
+class OutputConfig(BaseModel):
+    # 照片部分的最大边长，为空时使用 base.max_size
+    size: PositiveInt | None = None
+    # 输出格式，为空时与原图保持一致
+    format: Literal["jpeg", "png", "webp"] | None = None
+    # 输出质量，为空时使用 base.quality
+    quality: PositiveInt | None = None
+    # 添加在文件名后的后缀，例如 "_web"
+    suffix: str = ""
+
+    def get_filename(self, source: Path) -> str:
+        ext = OUTPUT_FORMAT_SUFFIXES[self.format] if self.format else source.suffix
+        return f"{source.stem}{self.suffix}{ext}"
+
+
 class Config(BaseModel, extra="allow"):
     base: BaseConfig = Field(default_factory=BaseConfig)
     layout: LayoutConfig = Field(default_factory=LayoutConfig)
     logo: LogoConfig = Field(default_factory=LogoConfig)
+    # 同一张照片的多个输出尺寸，为空时只输出一张与原图同名的图片
+    outputs: list[OutputConfig] = Field(default_factory=list)
 
     def model_post_init(self, _context) -> None:
         self.bg_color = self.layout.background_color
         self._logos = {}
+        self._scaled_logos = {}
 
     @classmethod
     def load(cls, path: str | Path) -> "Config":
@@ -128,6 +186,22 @@ class Config(BaseModel, extra="allow"):
         with open(path, "w", encoding="utf-8") as f:
             yaml.safe_dump(self.model_dump(), f)
 
+    def get_outputs(self) -> list[OutputConfig]:
+        """
+        获取按尺寸从大到小排列的输出配置，方便逐级缩小
+        :return: 输出配置列表
+        """
+        outputs = [
+            output.model_copy(
+                update={
+                    "size": output.size or self.base.max_size,
+                    "quality": output.quality or self.base.quality,
+                }
+            )
+            for output in self.outputs or [OutputConfig()]
+        ]
+        return sorted(outputs, key=lambda o: o.size or float("inf"), reverse=True)
+
     def get_font_padding_level(self):
         bold_font_size = self.base.bold_font_size
         font_size = self.base.font_size
@@ -139,11 +213,12 @@ class Config(BaseModel, extra="allow"):
     def get_bold_font_size(self):
         return get_bold_font_size(self.base.bold_font_size)
 
-    def get_font(self):
-        return ImageFont.truetype(self.base.font, self.get_font_size())
+    def get_font(self, scale: float = 1.0):
+        return load_font(self.base.font, max(1, round(self.get_font_size() * scale)))
 
-    def get_bold_font(self):
-        return ImageFont.truetype(self.base.bold_font, self.get_bold_font_size())
+    def get_bold_font(self, scale: float = 1.0):
+        size = max(1, round(self.get_bold_font_size() * scale))
+        return load_font(self.base.bold_font, size)
 
     def load_logo(self, make: str) -> Image.Image:
         """
@@ -158,10 +233,43 @@ class Config(BaseModel, extra="allow"):
             self.logo.directory.glob(f"{make.lower()}.*"), self.logo.default
         )
 
-        logo = Image.open(logo_path)
+        # 优先使用内存映射的 logo 图集，避免每个进程重复解码 PNG
+        atlas = load_logo_atlas(self.logo.directory)
+        logo = atlas.open(logo_path) if atlas is not None else None
+        if logo is None:
+            logo = Image.open(logo_path)
         self._logos[make] = logo
         return logo
 
+    def load_scaled_logo(self, make: str, height: int) -> Image.Image:
+        """
+        获取高度不超过指定高度的 logo，同一批照片尺寸相同，缩放结果按高度缓存
+        :param make: 厂商
+        :param height: 最大高度
+        :return: logo
+        """
+        key = (make, height)
+        if key in self._scaled_logos:
+            return self._scaled_logos[key]
+
+        logo = self.load_logo(make)
+        if logo.height > height:
+            # logo 通常远大于目标尺寸，先按整数倍快速缩小再用 LANCZOS 缩放
+            width = round(logo.width * height / logo.height)
+            factor = logo.height // (height * 3)
+            if factor > 1:
+                logo = logo.reduce(factor)
+            logo = logo.resize((width, height), Image.LANCZOS)
+        if len(self._scaled_logos) >= MAX_SCALED_LOGOS:
+            self._scaled_logos.clear()
+        self._scaled_logos[key] = logo
+        return logo
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, size)
+
 
 def get_font_size(level: int) -> int:
     if level < 1:
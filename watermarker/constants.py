@@ -1,3 +1,5 @@
+import os
+
 MODEL_VALUE = "Model"
 MAKE_VALUE = "Make"
 LENS_VALUE = "LensModel"
@@ -40,6 +42,8 @@ LOCATION_RIGHT_TOP = "right_top"
 LOCATION_RIGHT_BOTTOM = "right_bottom"
 TRANSPARENT = (0, 0, 0, 0)
 DEBUG = False
+# 调试模式：每个处理阶段结束后报告仍未释放的全尺寸图片
+DEBUG_BUFFERS = bool(os.environ.get("WATERMARKER_DEBUG_BUFFERS"))
 GRAY = "#CBCBC9"
 
 DEFAULT_VALUE = "--"
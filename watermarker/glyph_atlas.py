@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import math
+from typing import TYPE_CHECKING
+
+from PIL import Image, ImageDraw
+
+if TYPE_CHECKING:
+    from PIL.ImageFont import FreeTypeFont
+
+MAX_GLYPH_ATLASES = 32
+
+# 每个进程中的字形图集，键为 (字体文件, 字号, 字体索引)
+_atlases: dict[tuple, GlyphAtlas] = {}
+
+
+class GlyphAtlas:
+    """
+    缓存单个字体、字号下每个字符的覆盖度蒙版和字符间的步进，
+    绘制文字时直接从缓存中贴图，不再重复调用 FreeType 光栅化
+    """
+
+    def __init__(self, font: FreeTypeFont):
+        self.font = font
+        self._glyphs: dict[str, tuple[Image.Image | None, tuple[int, int]]] = {}
+        self._advances: dict[tuple[str, str], float] = {}
+
+    def get_glyph(self, char: str) -> tuple[Image.Image | None, tuple[int, int]]:
+        """
+        获取字符的覆盖度蒙版
+        :param char: 字符
+        :return: (蒙版, 蒙版相对基线原点的偏移)，空白字符的蒙版为 None
+        """
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            x0, y0, x1, y1 = self.font.getbbox(char, anchor="ls")
+            mask = None
+            if x1 > x0 and y1 > y0:
+                mask = Image.new("L", (x1 - x0, y1 - y0))
+                ImageDraw.Draw(mask).text(
+                    (-x0, -y0), char, fill=255, font=self.font, anchor="ls"
+                )
+            glyph = self._glyphs[char] = (mask, (x0, y0))
+        return glyph
+
+    def get_advance(self, char: str, next_char: str) -> float:
+        """
+        获取字符的步进，包含与下一个字符之间的字距调整
+        """
+        key = (char, next_char)
+        advance = self._advances.get(key)
+        if advance is None:
+            advance = self.font.getlength(char + next_char)
+            if next_char:
+                advance -= self.font.getlength(next_char)
+            self._advances[key] = advance
+        return advance
+
+    def draw_text(
+        self, draw: ImageDraw.ImageDraw, xy: tuple[int, int], content: str, fill: str
+    ) -> None:
+        """
+        以基线左端为锚点绘制单行文字，结果与 ImageDraw.text(anchor="ls") 一致
+        :param draw: 画布对应的 ImageDraw 对象
+        :param xy: 基线左端坐标
+        :param content: 文字内容
+        :param fill: 文字颜色
+        """
+        x, y = xy
+        # 步进按浮点数累加，每个字符的位置与 FreeType 一样四舍五入到整数像素，
+        # 不会因为逐个截断而向左偏移
+        pen = 0.0
+        for i, char in enumerate(content):
+            mask, (dx, dy) = self.get_glyph(char)
+            if mask is not None:
+                draw.bitmap((x + math.floor(pen + 0.5) + dx, y + dy), mask, fill=fill)
+            pen += self.get_advance(char, content[i + 1 : i + 2])
+
+
+def get_glyph_atlas(font: FreeTypeFont) -> GlyphAtlas:
+    """
+    获取字体对应的字形图集，同一字体文件和字号共享同一个图集
+    :param font: 字体
+    :return: 字形图集
+    """
+    key = (font.path, font.size, font.index)
+    atlas = _atlases.get(key)
+    if atlas is None:
+        # 字体种类有限，超出上限时直接清空，避免缩放后的字号无限增长
+        if len(_atlases) >= MAX_GLYPH_ATLASES:
+            _atlases.clear()
+        atlas = _atlases[key] = GlyphAtlas(font)
+    return atlas
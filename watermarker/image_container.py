@@ -1,16 +1,18 @@
 from __future__ import annotations
 
+import gc
 import logging
+import mmap
 import os
-import re
+import uuid
 from datetime import datetime
-from enum import Enum
 from pathlib import Path
+from typing import Any, Callable
 
-from dateutil import parser
-from PIL import Image
+from PIL import Image, ImageFilter, ImageStat
 from PIL.Image import Transpose
 
+from .buffer_pool import get_buffer_pool, release_canvas
 from .config import Element
 from .constants import (
     CAMERA_MAKE_CAMERA_MODEL_VALUE,
@@ -20,7 +22,7 @@ from .constants import (
     DATE_VALUE,
     DATETIME_FILENAME_VALUE,
     DATETIME_VALUE,
-    DEFAULT_VALUE,
+    DEBUG_BUFFERS,
     FILENAME_VALUE,
     GEO_INFO_VALUE,
     LENS_MAKE_LENS_MODEL_VALUE,
@@ -30,176 +32,151 @@ from .constants import (
     PARAM_VALUE,
     TOTAL_PIXEL_VALUE,
 )
+from .photo_meta import PhotoMeta
 from .utils import (
+    JPEG_SUFFIXES,
     calculate_pixel_count,
-    extract_attribute,
-    extract_gps_info,
-    extract_gps_lat_and_long,
     get_exif,
+    set_exif_orientation,
+    shrink_image,
+    to_working_mode,
 )
 
 logger = logging.getLogger(__name__)
 
 
-class ExifId(Enum):
-    CAMERA_MODEL = "CameraModelName"
-    CAMERA_MAKE = "Make"
-    LENS_MODEL = ["LensModel", "Lens", "LensID"]
-    LENS_MAKE = "LensMake"
-    DATETIME = "DateTimeOriginal"
-    FOCAL_LENGTH = "FocalLength"
-    FOCAL_LENGTH_IN_35MM_FILM = "FocalLengthIn35mmFormat"
-    F_NUMBER = "FNumber"
-    ISO = "ISO"
-    EXPOSURE_TIME = "ExposureTime"
-    SHUTTER_SPEED_VALUE = "ShutterSpeedValue"
-    ORIENTATION = "Orientation"
+# 打开时需要旋转的方向，保存时 EXIF 中的方向会被重置为正常
+ROTATED_ORIENTATIONS = ("Rotate 90 CW", "Rotate 180", "Rotate 270 CW")
 
 
-PATTERN = re.compile(r"(\d+)\.")  # 匹配小数
-
-
-def get_datetime(exif) -> datetime:
-    dt = datetime.now()
+def _is_loaded(image: Image.Image) -> bool:
+    # 已关闭的图片访问 im 时会抛出 ValueError，尚未解码的图片 im 为 None
     try:
-        dt = parser.parse(
-            extract_attribute(
-                exif, ExifId.DATETIME.value, default_value=str(datetime.now())
-            )
-        )
+        return image.im is not None
     except ValueError:
-        logger.info(
-            f"Error: 时间格式错误：{extract_attribute(exif, ExifId.DATETIME.value)}"
+        return False
+
+
+def _blur_image(image: Image.Image, radius: float, scale: float) -> Image.Image:
+    """
+    缩小图片后进行高斯模糊
+    :param image: 图片对象
+    :param radius: 原图尺寸下的高斯模糊半径
+    :param scale: 模糊前对图片的缩放比例
+    :return: 模糊后的新图片
+    """
+    if "A" in image.getbands():
+        # 背景不透明，与保存时一样直接去掉透明通道，缩放时不按透明度混合颜色
+        image = image.convert(image.mode[:-1])
+    if scale != 1.0:
+        size = (
+            max(1, round(image.width * scale)),
+            max(1, round(image.height * scale)),
         )
-    return dt
-
-
-def get_focal_length(exif: dict[str, str]) -> tuple[str, str]:
-    focal_length = DEFAULT_VALUE
-    focal_length_in_35mm_film = DEFAULT_VALUE
-
-    try:
-        focal_lengths = PATTERN.findall(
-            extract_attribute(exif, ExifId.FOCAL_LENGTH.value)
-        )
-        try:
-            focal_length = focal_lengths[0] if focal_length else DEFAULT_VALUE
-        except IndexError as e:
-            logger.error(f"ValueError: 不存在焦距：{focal_lengths} : {e}")
-        try:
-            focal_length_in_35mm_film: str = (
-                focal_lengths[1] if focal_length else DEFAULT_VALUE
-            )
-        except IndexError as e:
-            logger.error(f"ValueError: 不存在 35mm 焦距：{focal_lengths} : {e}")
-    except Exception as e:
-        logger.error(
-            f"KeyError: 焦距转换错误：{extract_attribute(exif, ExifId.FOCAL_LENGTH.value)} : {e}"
-        )
-
-    return focal_length, focal_length_in_35mm_film
+        image = image.resize(size, Image.BILINEAR)
+    return image.filter(ImageFilter.GaussianBlur(radius=radius * scale))
 
 
 class ImageContainer:
-    def __init__(self, path: Path):
+    def __init__(
+        self, path: Path, max_size: int | None = None, meta: PhotoMeta | None = None
+    ):
+        """
+        :param path: 照片路径
+        :param max_size: 解码时的最大边长
+        :param meta: 已读取的元数据，为空时首次使用时从 EXIF 中读取
+        """
         self.path = path
         self.target_path: Path | None = None
-        self.img: Image.Image = Image.open(path)
-        self.exif: dict = get_exif(path)
+        # 像素数据延迟到第一次使用基础图片时才解码，这里只读取文件头
+        self._source: Image.Image = Image.open(path)
+        self._img: Image.Image | None = None
+        self._max_size = max_size
+        # 元数据与像素相互独立，同样在第一次使用时才读取
+        self._exif: dict | None = None
+        self._meta = meta
+        self._params: dict[str, str] | None = None
         # 图像信息
-        self.original_width = self.img.width
-        self.original_height = self.img.height
-
-        self._param_dict = dict()
-
-        self.model: str = extract_attribute(self.exif, ExifId.CAMERA_MODEL.value)
-        self.make: str = extract_attribute(self.exif, ExifId.CAMERA_MAKE.value)
-        self.lens_model: str = extract_attribute(self.exif, *ExifId.LENS_MODEL.value)
-        self.lens_make: str = extract_attribute(self.exif, ExifId.LENS_MAKE.value)
-        self.date: datetime = get_datetime(self.exif)
-        self.focal_length, self.focal_length_in_35mm_film = get_focal_length(self.exif)
-        self.f_number: str = extract_attribute(
-            self.exif, ExifId.F_NUMBER.value, default_value=DEFAULT_VALUE
-        )
-        self.exposure_time: str = extract_attribute(
-            self.exif,
-            ExifId.EXPOSURE_TIME.value,
-            default_value=DEFAULT_VALUE,
-            suffix="s",
-        )
-        self.iso: str = extract_attribute(
-            self.exif, ExifId.ISO.value, default_value=DEFAULT_VALUE
-        )
+        self.original_width = self._source.width
+        self.original_height = self._source.height
 
         # 是否使用等效焦距
         self.use_equivalent_focal_length: bool = False
 
-        # 修正图像方向
-        self.orientation = (
-            self.exif[ExifId.ORIENTATION.value]
-            if ExifId.ORIENTATION.value in self.exif
-            else 1
-        )
-        if self.orientation == "Rotate 0":
-            pass
-        elif self.orientation == "Rotate 90 CW":
-            self.img = self.img.transpose(Transpose.ROTATE_270)
-        elif self.orientation == "Rotate 180":
-            self.img = self.img.transpose(Transpose.ROTATE_180)
-        elif self.orientation == "Rotate 270 CW":
-            self.img = self.img.transpose(Transpose.ROTATE_90)
-        else:
-            pass
-
         # 水印设置
         self.custom = "无"
         self.logo = None
 
         # 水印图片
         self.watermark_img = None
+        # 分块处理时水印图片的数据所在的内存映射
+        self._watermark_buffer: mmap.mmap | None = None
 
-        self._param_dict[MODEL_VALUE] = self.model
-        self._param_dict[PARAM_VALUE] = self.get_param_str()
-        self._param_dict[MAKE_VALUE] = self.make
-        self._param_dict[DATETIME_VALUE] = self._parse_datetime()
-        self._param_dict[DATE_VALUE] = self._parse_date()
-        self._param_dict[LENS_VALUE] = self.lens_model
-        filename_without_ext = os.path.splitext(self.path.name)[0]
-        self._param_dict[FILENAME_VALUE] = filename_without_ext
-        self._param_dict[TOTAL_PIXEL_VALUE] = calculate_pixel_count(
-            self.original_width, self.original_height
-        )
+        # 由基础图片派生的中间结果，在多个处理器和布局之间共享
+        self._intermediates: dict[tuple, Any] = {}
 
-        # GPS 信息
-        if "GPSPosition" in self.exif:
-            self._param_dict[GEO_INFO_VALUE] = str.join(
-                " ", extract_gps_info(self.exif.get("GPSPosition"))
-            )
-        elif "GPSLatitude" in self.exif and "GPSLongitude" in self.exif:
-            self._param_dict[GEO_INFO_VALUE] = str.join(
-                " ",
-                extract_gps_lat_and_long(
-                    (self.exif.get("GPSLatitude"), self.exif.get("GPSLongitude"))
-                ),
-            )
-        else:
-            self._param_dict[GEO_INFO_VALUE] = "无"
+    @property
+    def exif(self) -> dict:
+        """
+        exiftool 输出的原始 EXIF 信息
+        """
+        if self._exif is None:
+            self._exif = get_exif(self.path)
+        return self._exif
 
-        self._param_dict[CAMERA_MAKE_CAMERA_MODEL_VALUE] = " ".join(
-            [self._param_dict[MAKE_VALUE], self._param_dict[MODEL_VALUE]]
+    @property
+    def meta(self) -> PhotoMeta:
+        """
+        规范化后的元数据
+        """
+        if self._meta is None:
+            self._meta = PhotoMeta.from_exif(
+                self.exif, self.original_width, self.original_height
+            )
+        return self._meta
+
+    def __getattr__(self, name: str) -> Any:
+        # model、make、date 等元数据字段直接从 PhotoMeta 中读取
+        if name in PhotoMeta.__slots__:
+            return getattr(self.meta, name)
+        raise AttributeError(name)
+
+    @property
+    def _param_dict(self) -> dict[str, str]:
+        if self._params is None:
+            self._params = self._build_param_dict()
+        return self._params
+
+    def _build_param_dict(self) -> dict[str, str]:
+        params = {
+            MODEL_VALUE: self.model,
+            PARAM_VALUE: self.get_param_str(),
+            MAKE_VALUE: self.make,
+            DATETIME_VALUE: self._parse_datetime(),
+            DATE_VALUE: self._parse_date(),
+            LENS_VALUE: self.lens_model,
+            FILENAME_VALUE: os.path.splitext(self.path.name)[0],
+            TOTAL_PIXEL_VALUE: calculate_pixel_count(
+                self.original_width, self.original_height
+            ),
+            GEO_INFO_VALUE: self.geo_info,
+        }
+        params[CAMERA_MAKE_CAMERA_MODEL_VALUE] = " ".join(
+            [params[MAKE_VALUE], params[MODEL_VALUE]]
         )
-        self._param_dict[LENS_MAKE_LENS_MODEL_VALUE] = " ".join(
-            [self.lens_make, self._param_dict[LENS_VALUE]]
+        params[LENS_MAKE_LENS_MODEL_VALUE] = " ".join(
+            [self.lens_make, params[LENS_VALUE]]
         )
-        self._param_dict[CAMERA_MODEL_LENS_MODEL_VALUE] = " ".join(
-            [self._param_dict[MODEL_VALUE], self._param_dict[LENS_VALUE]]
+        params[CAMERA_MODEL_LENS_MODEL_VALUE] = " ".join(
+            [params[MODEL_VALUE], params[LENS_VALUE]]
         )
-        self._param_dict[DATE_FILENAME_VALUE] = " ".join(
-            [self._param_dict[DATE_VALUE], self._param_dict[FILENAME_VALUE]]
+        params[DATE_FILENAME_VALUE] = " ".join(
+            [params[DATE_VALUE], params[FILENAME_VALUE]]
         )
-        self._param_dict[DATETIME_FILENAME_VALUE] = " ".join(
-            [self._param_dict[DATETIME_VALUE], self._param_dict[FILENAME_VALUE]]
+        params[DATETIME_FILENAME_VALUE] = " ".join(
+            [params[DATETIME_VALUE], params[FILENAME_VALUE]]
         )
+        return params
 
     def get_height(self):
         return self.get_watermark_img().height
@@ -214,11 +191,128 @@ class ImageContainer:
         return self.make
 
     def get_ratio(self):
-        return self.img.width / self.img.height
+        width, height = self.get_size()
+        return width / height
+
+    @property
+    def img(self) -> Image.Image:
+        if self._img is None:
+            self._img = self._load_img()
+        return self._img
+
+    @img.setter
+    def img(self, value: Image.Image) -> None:
+        self._img = value
+
+    def is_loaded(self) -> bool:
+        """
+        基础图片的像素是否已经解码
+        """
+        return self._img is not None
+
+    def _load_img(self) -> Image.Image:
+        # 调色板、16 位等无法绘制的模式先转换，透明通道、灰度和 CMYK 保持到保存时
+        image = to_working_mode(self._source)
+        # 输出尺寸小于原图时，直接以较小的尺寸解码
+        if self._max_size is not None:
+            image = shrink_image(image, self._max_size)
+        # 修正图像方向
+        if self.orientation == "Rotate 90 CW":
+            image = image.transpose(Transpose.ROTATE_270)
+        elif self.orientation == "Rotate 180":
+            image = image.transpose(Transpose.ROTATE_180)
+        elif self.orientation == "Rotate 270 CW":
+            image = image.transpose(Transpose.ROTATE_90)
+        return image
+
+    def get_size(self) -> tuple[int, int]:
+        """
+        获取已修正方向的基础图片尺寸，尚未解码时根据文件头计算，不会触发解码
+        """
+        if self._img is not None:
+            return self._img.size
+        width, height = self.original_width, self.original_height
+        if self._max_size is not None:
+            scale = self._max_size / max(width, height)
+            if scale < 1:
+                width = max(1, round(width * scale))
+                height = max(1, round(height * scale))
+        if self.orientation in ("Rotate 90 CW", "Rotate 270 CW"):
+            width, height = height, width
+        return width, height
 
     def get_img(self):
+        """
+        获取已修正方向的基础图片，多个处理器共享，不能修改。第一次调用时解码
+        """
         return self.img
 
+    def get_intermediate(self, key: tuple, factory: Callable[[], Any]) -> Any:
+        """
+        获取由基础图片派生的中间结果，首次请求时调用 factory 生成，基础图片变化时释放
+        :param key: 中间结果的键
+        :param factory: 生成中间结果的函数
+        """
+        if key not in self._intermediates:
+            self._intermediates[key] = factory()
+        return self._intermediates[key]
+
+    def _clear_intermediates(self) -> None:
+        for value in self._intermediates.values():
+            if isinstance(value, Image.Image):
+                value.close()
+        self._intermediates.clear()
+
+    def get_blurred_img(
+        self, radius: float, scale: float = 1.0, image: Image.Image | None = None
+    ) -> Image.Image:
+        """
+        获取模糊后的图片。模糊基础图片时首次请求计算，之后直接复用，不能修改；
+        模糊其他阶段的图片（例如已经加上阴影的画面）时每次重新计算，由调用方关闭
+        :param radius: 原图尺寸下的高斯模糊半径
+        :param scale: 模糊前对图片的缩放比例
+        :param image: 需要模糊的图片，为空时使用基础图片
+        :return: 模糊后的图片对象，尺寸为图片尺寸乘以 scale
+        """
+        if image is not None and image is not self.img:
+            return _blur_image(image, radius, scale)
+        return self.get_intermediate(
+            ("blurred_base", radius, scale),
+            lambda: _blur_image(self.img, radius, scale),
+        )
+
+    def get_average_color(self) -> tuple[int, ...]:
+        """
+        获取基础图片的平均颜色（RGB），首次请求时计算，之后直接复用
+        """
+
+        def average() -> tuple[int, ...]:
+            image = self.img if self.img.mode == "RGB" else self.img.convert("RGB")
+            with image.reduce(8) as small:
+                return tuple(round(v) for v in ImageStat.Stat(small).mean)
+
+        return self.get_intermediate(("average_color",), average)
+
+    def shrink(self, max_size: int) -> None:
+        """
+        按照最大边长缩小基础图片，用于同一次解码输出多个尺寸
+        :param max_size: 最大边长
+        """
+        if self._img is None:
+            # 尚未解码时只记录尺寸，解码时直接以较小的尺寸解码
+            if self._max_size is None or max_size < self._max_size:
+                self._max_size = max_size
+            return
+        self.img = shrink_image(self.img, max_size)
+        # 基础图片已变化，之前的中间结果不再可用
+        self._clear_intermediates()
+
+    def get_scale(self) -> float:
+        """
+        解码后的图片相对原图的缩放比例
+        """
+        return max(self.get_size()) / max(self.original_width, self.original_height)
+
     def _parse_datetime(self) -> str:
         """
         解析日期，转换为指定的格式
@@ -288,19 +382,76 @@ class ImageContainer:
 
     def is_use_equivalent_focal_length(self, flag: bool) -> None:
         self.use_equivalent_focal_length = flag
+        self._param_dict[PARAM_VALUE] = self.get_param_str()
 
     def get_watermark_img(self) -> Image.Image:
+        """
+        获取当前阶段的输入图片。第一个处理器直接拿到基础图片而不是副本，
+        处理器只能读取输入并生成新的图片，不能原地修改
+        """
         if self.watermark_img is None:
-            self.watermark_img = self.img.copy()
+            self.watermark_img = self.img
         return self.watermark_img
 
-    def update_watermark_img(self, watermark_img) -> None:
-        if self.watermark_img == watermark_img:
+    def update_watermark_img(
+        self, watermark_img, buffer: mmap.mmap | None = None
+    ) -> None:
+        """
+        设置当前阶段的输出图片，容器接管它的所有权，并立即释放上一阶段的图片
+        :param watermark_img: 输出图片
+        :param buffer: 图片数据所在的内存映射，释放图片时一并关闭
+        """
+        if self.watermark_img is watermark_img:
             return
-        original_watermark_img = self.watermark_img
+        self._release(self.watermark_img)
         self.watermark_img = watermark_img
-        if original_watermark_img is not None:
-            original_watermark_img.close()
+        self._watermark_buffer = buffer
+
+    def reset_watermark_img(self) -> None:
+        """
+        丢弃已生成的水印图片，下次处理时重新从基础图片开始
+        """
+        self._release(self.watermark_img)
+        self.watermark_img = None
+
+    def _release(self, image: Image.Image | None) -> None:
+        # 基础图片在多个布局和尺寸之间共享，只释放各阶段生成的图片
+        if image is not None and image is not self._img:
+            release_canvas(image)
+        buffer, self._watermark_buffer = self._watermark_buffer, None
+        if buffer is None:
+            return
+        try:
+            buffer.close()
+        except BufferError:
+            # 仍有图片引用映射的内存，这些图片释放后由垃圾回收关闭
+            logger.debug(f"水印图片的内存映射仍在使用，延迟关闭：{self.path}")
+
+    def check_buffers(self, stage: str) -> None:
+        """
+        调试模式下，在处理阶段结束后报告仍未释放的全尺寸图片
+        :param stage: 阶段名称
+        """
+        if not DEBUG_BUFFERS or self._img is None:
+            return
+        owned = {id(self.img), id(self.watermark_img)}
+        owned.update(id(value) for value in self._intermediates.values())
+        threshold = self.img.width * self.img.height // 2
+        pool = get_buffer_pool()
+        for obj in gc.get_objects():
+            # 只读图片映射自文件（例如 logo 图集），不占用进程的堆内存
+            if (
+                isinstance(obj, Image.Image)
+                and not obj.readonly
+                and id(obj) not in owned
+                and not pool.is_pooled(obj)
+                and obj.width * obj.height >= threshold
+                and _is_loaded(obj)
+            ):
+                logger.warning(
+                    f"{self.path.name}：阶段 {stage} 结束后仍有未释放的全尺寸图片 "
+                    f"{obj.mode} {obj.width}x{obj.height}"
+                )
 
     def __enter__(self):
         return self
@@ -309,31 +460,42 @@ class ImageContainer:
         self.close()
 
     def close(self):
-        self.img.close()
-        if self.watermark_img is not None:
-            self.watermark_img.close()
+        self._clear_intermediates()
+        self._release(self.watermark_img)
+        self.watermark_img = None
+        if self._img is not None:
+            self._img.close()
+        self._source.close()
 
     def save(self, target_path, quality=100):
-        if self.orientation == "Rotate 0":
-            pass
-        elif self.orientation == "Rotate 90 CW":
-            self.watermark_img = self.watermark_img.transpose(Transpose.ROTATE_90)
-        elif self.orientation == "Rotate 180":
-            self.watermark_img = self.watermark_img.transpose(Transpose.ROTATE_180)
-        elif self.orientation == "Rotate 270 CW":
-            self.watermark_img = self.watermark_img.transpose(Transpose.ROTATE_270)
-        else:
-            pass
-
-        if self.watermark_img.mode != "RGB":
-            self.watermark_img = self.watermark_img.convert("RGB")
-
+        # 照片只在打开时按方向旋转一次，保存时不再旋转回去，而是把 EXIF 中的方向改为正常
+        # JPEG 编码器可以直接读取 RGBX 图片（分块处理的结果），不需要转换
+        mode = self.watermark_img.mode
+        if mode != "RGB" and not (
+            mode == "RGBX" and Path(target_path).suffix.lower() in JPEG_SUFFIXES
+        ):
+            converted = self.watermark_img.convert("RGB")
+            self._release(self.watermark_img)
+            self.watermark_img = converted
+
+        kwargs = {}
         if "exif" in self.img.info:
+            exif = self.img.info["exif"]
+            if self.orientation in ROTATED_ORIENTATIONS:
+                exif = set_exif_orientation(exif, 1)
+            kwargs["exif"] = exif
+
+        # 先写入同一目录下的临时文件再替换，其他进程或节点同时写入同一张照片时，
+        # 目标文件始终是某一次完整的输出
+        target_path = Path(target_path)
+        tmp_path = target_path.with_name(
+            f".{target_path.stem}.{uuid.uuid4().hex[:8]}{target_path.suffix}"
+        )
+        try:
             self.watermark_img.save(
-                target_path,
-                quality=quality,
-                encoding="utf-8",
-                exif=self.img.info["exif"] if "exif" in self.img.info else "",
+                tmp_path, quality=quality, encoding="utf-8", **kwargs
             )
-        else:
-            self.watermark_img.save(target_path, quality=quality, encoding="utf-8")
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
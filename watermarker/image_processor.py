@@ -1,22 +1,42 @@
+from __future__ import annotations
+
+import functools
+import mmap
 import string
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
 
-from PIL import Image, ImageFilter, ImageOps
+from PIL import Image, ImageDraw, ImageFilter, ImageOps
 
-from .config import Config, Layout
+from .buffer_pool import get_color, new_canvas, release_canvas
+from .config import Config, Element, Layout
 from .constants import GRAY, NONE_VALUE, TRANSPARENT
 from .image_container import ImageContainer
+from .text_layout import (
+    ColumnBox,
+    ImageBox,
+    RectBox,
+    RowBox,
+    SpaceBox,
+    TextBox,
+    draw_boxes_by_side,
+)
 from .utils import (
     Align,
-    Axis,
-    append_image_by_side,
-    concatenate_images,
+    fill_border,
+    get_padding_geometry,
+    get_text_height,
+    nine_slice,
     padding_image,
     resize_image_with_height,
     resize_image_with_width,
     square_image,
-    text_to_image,
 )
 
+if TYPE_CHECKING:
+    from PIL.ImageFont import FreeTypeFont
+
 printable = set(string.printable)
 
 NORMAL_HEIGHT = 1000
@@ -30,6 +50,13 @@ LINE_GRAY = Image.new("RGBA", (20, 1000), color=GRAY)
 LINE_TRANSPARENT = Image.new("RGBA", (20, 1000), color=TRANSPARENT)
 
 
+Size = tuple[int, int]
+Box = tuple[int, int, int, int]
+
+# 分块处理时每个分块的最大像素数
+TILE_PIXELS = 16 * 1024 * 1024
+
+
 class ProcessorComponent:
     """
     图片处理器组件
@@ -37,6 +64,8 @@ class ProcessorComponent:
 
     LAYOUT_ID: Layout | None = None
     LAYOUT_NAME: str | None = None
+    # process 过程中同时持有的全尺寸图片数量，用于估算内存占用
+    BUFFER_COUNT = 1
 
     def __init__(self, config: Config):
         self.config = config
@@ -47,10 +76,47 @@ class ProcessorComponent:
         """
         raise NotImplementedError
 
+    def plan(self, container: ImageContainer, size: Size) -> tuple[Size, Size] | None:
+        """
+        计算处理后的图片尺寸，以及处理前的图片在处理后图片中的位置
+        :param container: 图片容器
+        :param size: 处理前的图片尺寸
+        :return: (处理后的尺寸, 处理前图片的位置)，不支持规划时返回 None
+        """
+        return None
+
+    def render(
+        self, container: ImageContainer, canvas: Image.Image, box: Box, inner_box: Box
+    ) -> None:
+        """
+        在最终画布上绘制本组件添加的内容，处理前的图片随后会绘制到 inner_box 中
+        :param container: 图片容器
+        :param canvas: 最终画布
+        :param box: 处理后的图片在画布中的区域
+        :param inner_box: 处理前的图片在画布中的区域
+        """
+        raise NotImplementedError
+
     def add(self, component):
         raise NotImplementedError
 
 
+def has_border_in_rows(box: Box, inner_box: Box, height: int) -> bool:
+    """
+    box 中除 inner_box 以外的区域是否与 [0, height) 行相交
+    """
+
+    def intersects(top: int, bottom: int) -> bool:
+        return top < bottom and top < height and bottom > 0
+
+    has_sides = inner_box[0] > box[0] or inner_box[2] < box[2]
+    return (
+        intersects(box[1], inner_box[1])
+        or intersects(inner_box[3], box[3])
+        or (has_sides and intersects(inner_box[1], inner_box[3]))
+    )
+
+
 class ProcessorChain(ProcessorComponent):
     def __init__(self, config: Config):
         super().__init__(config)
@@ -59,9 +125,120 @@ class ProcessorChain(ProcessorComponent):
     def add(self, component: ProcessorComponent) -> None:
         self.components.append(component)
 
+    def get_buffer_count(self) -> int:
+        """
+        估算处理过程中除原图以外同时持有的全尺寸图片数量
+        :return: 可以规划时只有最终画布；否则为上一步的结果加上当前组件持有的图片
+        """
+        if not self.components:
+            return 0
+        if all(type(c).plan is not ProcessorComponent.plan for c in self.components):
+            return 1
+        return 1 + max(c.BUFFER_COUNT for c in self.components)
+
     def process(self, container: ImageContainer) -> None:
+        steps = self._plan(container)
+        if steps is None:
+            for component in self.components:
+                component.process(container)
+                container.check_buffers(type(component).__name__)
+        else:
+            self._render(container, steps)
+            container.check_buffers(type(self).__name__)
+
+    def _plan(
+        self, container: ImageContainer
+    ) -> list[tuple[ProcessorComponent, Size, Size, Size]] | None:
+        """
+        规划阶段：所有组件都只改变几何尺寸时，预先计算每一步的尺寸和位置
+        :return: 每一步的 (组件, 处理前尺寸, 处理后尺寸, 处理前图片的位置)，
+            无法规划时返回 None
+        """
+        if container.watermark_img is not None or not self.components:
+            return None
+        steps = []
+        size = container.get_img().size
         for component in self.components:
-            component.process(container)
+            geometry = component.plan(container, size)
+            if geometry is None:
+                return None
+            new_size, offset = geometry
+            steps.append((component, size, new_size, offset))
+            size = new_size
+        return steps
+
+    def _render(
+        self,
+        container: ImageContainer,
+        steps: list[tuple[ProcessorComponent, Size, Size, Size]],
+    ) -> None:
+        # 只分配一次最终画布，从最外层开始依次绘制，最后放入原图
+        mode = container.get_img().mode
+        canvas = new_canvas(mode, steps[-1][2], color=self.config.bg_color)
+        try:
+            self._draw(container, steps, canvas)
+        except BaseException:
+            release_canvas(canvas)
+            raise
+        container.update_watermark_img(canvas)
+
+    def _draw(
+        self,
+        container: ImageContainer,
+        steps: list[tuple[ProcessorComponent, Size, Size, Size]],
+        canvas: Image.Image,
+        top: int = 0,
+    ) -> None:
+        """
+        将规划好的布局绘制到画布上
+        :param canvas: 画布，可以只是最终图片中的一个分块
+        :param top: 画布在最终图片中的纵坐标
+        """
+        x, y = 0, -top
+        for component, size, new_size, (dx, dy) in reversed(steps):
+            box = (x, y, x + new_size[0], y + new_size[1])
+            x, y = x + dx, y + dy
+            inner_box = (x, y, x + size[0], y + size[1])
+            # 分块与这一层的边框没有交集时跳过，例如只包含原图的分块
+            if has_border_in_rows(box, inner_box, canvas.height):
+                component.render(container, canvas, box, inner_box)
+        canvas.paste(container.get_img(), (x, y))
+
+    def process_tiled(self, container: ImageContainer, directory: Path) -> bool:
+        """
+        分块处理超大图片：按行分块绘制规划好的布局，写入磁盘上的临时文件，
+        再以内存映射的方式交给编码器，画布占用的内存只与分块大小有关。
+        每个分块仍然从完整解码的 container.get_img() 中粘贴原图，
+        所以峰值内存只减少了输出画布的大小
+        :param container: 图片容器
+        :param directory: 临时文件所在的目录
+        :return: 布局无法规划时返回 False，需要使用普通的处理方式
+        """
+        steps = self._plan(container)
+        if steps is None:
+            return False
+        mode = container.get_img().mode
+        if mode != "RGB":
+            return False
+        width, height = steps[-1][2]
+        # 以 RGBX 格式保存，编码器可以直接读取内存映射的数据，不需要复制
+        row_size = width * 4
+        band_height = max(1, TILE_PIXELS // width)
+        with tempfile.TemporaryFile(dir=directory) as f:
+            f.truncate(row_size * height)
+            buffer = mmap.mmap(f.fileno(), row_size * height)
+        for top in range(0, height, band_height):
+            bottom = min(height, top + band_height)
+            band = new_canvas(mode, (width, bottom - top), color=self.config.bg_color)
+            try:
+                self._draw(container, steps, band, top)
+                buffer[top * row_size : bottom * row_size] = band.tobytes("raw", "RGBX")
+            finally:
+                release_canvas(band)
+        image = Image.frombuffer("RGBX", (width, height), buffer, "raw", "RGBX", 0, 1)
+        # 容器释放水印图片时关闭内存映射，不等待垃圾回收
+        container.update_watermark_img(image, buffer)
+        return True
 
 
 class EmptyProcessor(ProcessorComponent):
@@ -69,24 +246,83 @@ class EmptyProcessor(ProcessorComponent):
         pass
 
 
-class ShadowProcessor(ProcessorComponent):
-    def process(self, container: ImageContainer) -> None:
-        # 加载图像
-        image = container.get_watermark_img()
+SHADOW_COLOR = "#6B696A"
+# 阴影九宫格中灰色区域的边长与模糊半径的比值，保证边缘中间不受角落影响
+SHADOW_SLICE_SIZE = 8
 
-        max_pixel = max(image.width, image.height)
-        # 计算阴影边框大小
-        radius = int(max_pixel / 512)
 
+@functools.lru_cache(maxsize=8)
+def get_shadow_slices(radius: int, mode: str = "RGB") -> Image.Image:
+    """
+    生成阴影九宫格：较小的灰色矩形加上白色边框后模糊，拉伸后与全尺寸模糊的结果一致
+    :param radius: 模糊半径
+    :param mode: 九宫格图片的模式，与画布保持一致
+    :return: 九宫格图片，不能修改
+    """
+    shadow = Image.new("RGB", (radius * SHADOW_SLICE_SIZE,) * 2, color=SHADOW_COLOR)
+    shadow = ImageOps.expand(shadow, border=radius * 2, fill=(255, 255, 255))
+    shadow = shadow.filter(ImageFilter.GaussianBlur(radius=radius))
+    return shadow if mode == "RGB" else shadow.convert(mode)
+
+
+class ShadowProcessor(ProcessorComponent):
+    @staticmethod
+    def get_radius(size: Size) -> int:
+        # 计算阴影边框大小
+        return int(max(size) / 512)
+
+    def plan(self, container: ImageContainer, size: Size) -> tuple[Size, Size]:
+        radius = self.get_radius(size)
+        if radius == 0:
+            return size, (0, 0)
+        return (size[0] + radius * 4, size[1] + radius * 4), (radius, radius)
+
+    def render(
+        self, container: ImageContainer, canvas: Image.Image, box: Box, inner_box: Box
+    ) -> None:
+        radius = inner_box[0] - box[0]
+        if radius == 0:
+            return
+        size = (box[2] - box[0], box[3] - box[1])
+        slices = get_shadow_slices(radius, canvas.mode)
+        if size[0] >= slices.width and size[1] >= slices.height:
+            # 只有边缘一圈阴影可见，用九宫格拉伸代替全尺寸模糊
+            nine_slice(slices, size, canvas, box[:2])
+        else:
+            with self.create_shadow(
+                size[0] - radius * 4, size[1] - radius * 4
+            ) as shadow:
+                canvas.paste(shadow, box[:2])
+
+    @staticmethod
+    def create_shadow(width: int, height: int) -> Image.Image:
+        radius = ShadowProcessor.get_radius((width, height))
         # 创建阴影效果
-        shadow = Image.new("RGB", image.size, color="#6B696A")
+        shadow = Image.new("RGB", (width, height), color=SHADOW_COLOR)
         shadow = ImageOps.expand(
             shadow,
             border=(radius * 2, radius * 2, radius * 2, radius * 2),
             fill=(255, 255, 255),
         )
         # 模糊阴影
-        shadow = shadow.filter(ImageFilter.GaussianBlur(radius=radius))
+        return shadow.filter(ImageFilter.GaussianBlur(radius=radius))
+
+    def process(self, container: ImageContainer) -> None:
+        # 加载图像
+        image = container.get_watermark_img()
+
+        radius = self.get_radius(image.size)
+        if radius == 0:
+            # 图片太小时阴影会被图片完全覆盖
+            return
+
+        size = (image.width + radius * 4, image.height + radius * 4)
+        slices = get_shadow_slices(radius, image.mode)
+        if size[0] >= slices.width and size[1] >= slices.height:
+            # 只有边缘一圈阴影可见，用九宫格拉伸代替全尺寸模糊
+            shadow = nine_slice(slices, size)
+        else:
+            shadow = self.create_shadow(image.width, image.height)
 
         # 将原始图像放置在阴影图像上方
         shadow.paste(image, (radius, radius))
@@ -97,6 +333,19 @@ class SquareProcessor(ProcessorComponent):
     LAYOUT_ID = Layout.SQUARE
     LAYOUT_NAME = "1:1填充"
 
+    def plan(self, container: ImageContainer, size: Size) -> tuple[Size, Size]:
+        width, height = size
+        # 与 square_image 相同，在较短的一边两侧填充
+        delta = abs(width - height) // 2
+        padding = (delta, 0) if width < height else (0, delta)
+        new_size = (width + padding[0] * 2, height + padding[1] * 2)
+        return new_size, padding
+
+    def render(
+        self, container: ImageContainer, canvas: Image.Image, box: Box, inner_box: Box
+    ) -> None:
+        fill_border(canvas, box, inner_box, "white")
+
     def process(self, container: ImageContainer) -> None:
         image = container.get_watermark_img()
         container.update_watermark_img(square_image(image, auto_close=False))
@@ -124,134 +373,209 @@ class StandardProcessor(ProcessorComponent):
     def is_logo_left(self):
         return self.logo_position == "left"
 
+    def get_normal_width(self, container: ImageContainer) -> int:
+        # 下方水印的占比
+        ratio = (
+            0.07 if container.get_ratio() >= 1 else 0.1
+        ) + 0.02 * self.config.get_font_padding_level()
+        return int(NORMAL_HEIGHT / ratio)
+
+    def get_watermark_height(self, container: ImageContainer, width: int) -> int:
+        """
+        水印缩放到指定宽度后的高度
+        """
+        return round(NORMAL_HEIGHT * width / self.get_normal_width(container))
+
+    def plan(self, container: ImageContainer, size: Size) -> tuple[Size, Size]:
+        width, height = size
+        return (width, height + self.get_watermark_height(container, width)), (0, 0)
+
+    def render(
+        self, container: ImageContainer, canvas: Image.Image, box: Box, inner_box: Box
+    ) -> None:
+        width = box[2] - box[0]
+        # 分块处理时会对多个分块调用，水印区域只绘制一次
+        watermark = container.get_intermediate(
+            ("standard_footer", id(self), width, canvas.mode),
+            lambda: self.render_watermark(container, width, canvas.mode),
+        )
+        fill_border(canvas, box, inner_box, self.bg_color)
+        canvas.paste(watermark, (box[0], inner_box[3]))
+
     def process(self, container: ImageContainer) -> None:
         """
         生成一个默认布局的水印图片
         :param container: 图片对象
         :return: 添加水印后的图片对象
         """
+        image = container.get_watermark_img()
+        watermark = self.render_watermark(container, image.width, image.mode)
+        # 一次性分配与原图模式相同的最终画布，放入原图和下方的水印区域
+        result = new_canvas(
+            image.mode,
+            (image.width, image.height + watermark.height),
+            color=self.bg_color,
+        )
+        result.paste(image, (0, 0))
+        result.paste(watermark, (0, image.height))
+        watermark.close()
+        # 更新图片对象
+        container.update_watermark_img(result)
+
+    def build_column(
+        self,
+        container: ImageContainer,
+        items: list[tuple[Element, bool, str]],
+        font: FreeTypeFont,
+        bold_font: FreeTypeFont,
+        spacing: int,
+    ) -> ColumnBox:
+        """
+        构建一列文字，文字之间使用 spacing 分隔
+        :param items: (元素, 是否加粗, 颜色) 列表
+        """
+        children = []
+        for element, is_bold, fill in items:
+            if element.name == NONE_VALUE:
+                continue
+            if children:
+                children.append(SpaceBox(10, spacing))
+            content = container.get_attribute_str(element)
+            children.append(
+                TextBox(
+                    content,
+                    font,
+                    bold_font,
+                    is_bold,
+                    fill,
+                    self.config.layout.use_glyph_atlas,
+                )
+            )
+        return ColumnBox(children, Align.START)
+
+    def render_watermark(
+        self, container: ImageContainer, width: int, mode: str = "RGB"
+    ) -> Image.Image:
+        """
+        绘制下方的水印区域，背景不透明，logo 等带透明通道的元素在绘制时混合
+        :param container: 图片对象
+        :param width: 水印宽度
+        :param mode: 水印图片的模式，与照片保持一致
+        :return: 水印图片
+        """
         config = self.config
         config.bg_color = self.bg_color
 
-        # 下方水印的占比
-        ratio = (
-            0.07 if container.get_ratio() >= 1 else 0.1
-        ) + 0.02 * config.get_font_padding_level()
-
-        # 创建一个空白的水印图片
-        watermark = Image.new(
-            "RGBA", (int(NORMAL_HEIGHT / ratio), NORMAL_HEIGHT), color=self.bg_color
+        # 按照输出宽度计算缩放比例，字号、间距等都按比例缩放后直接绘制
+        normal_width = self.get_normal_width(container)
+        if config.layout.render_at_target_size:
+            scale = width / normal_width
+            watermark_size = (width, round(NORMAL_HEIGHT * scale))
+        else:
+            scale = 1.0
+            watermark_size = (normal_width, NORMAL_HEIGHT)
+
+        def scaled(value: float) -> int:
+            return max(1, round(value * scale))
+
+        font = config.get_font(scale)
+        bold_font = config.get_bold_font(scale)
+        padding = (scaled(300), scaled(200))
+        gap = scaled(200)
+
+        # 创建一个空白的水印图片，CMYK 照片的水印按 RGB 绘制，粘贴时再转换
+        if mode == "CMYK":
+            mode = "RGB"
+        watermark = Image.new(mode, watermark_size, color=self.bg_color)
+
+        # 先测量所有元素的尺寸，再直接绘制到水印图片上
+        elements = config.layout.elements
+        left = self.build_column(
+            container,
+            [
+                (elements.left_top, self.bold_font_lt, self.font_color_lt),
+                (elements.left_bottom, self.bold_font_lb, self.font_color_lb),
+            ],
+            font,
+            bold_font,
+            scaled(100),
+        )
+        right = self.build_column(
+            container,
+            [
+                (elements.right_top, self.bold_font_rt, self.font_color_rt),
+                (elements.right_bottom, self.bold_font_rb, self.font_color_rb),
+            ],
+            font,
+            bold_font,
+            scaled(100),
         )
 
-        with Image.new("RGBA", (10, 100), color=self.bg_color) as empty_padding:
-            # 填充左边的文字内容
-            left_parts = []
-            if config.layout.elements.left_top.name != NONE_VALUE:
-                left_parts.append(
-                    text_to_image(
-                        container.get_attribute_str(config.layout.elements.left_top),
-                        config.get_font(),
-                        config.get_bold_font(),
-                        is_bold=self.bold_font_lt,
-                        fill=self.font_color_lt,
-                    )
-                )
-            if config.layout.elements.left_bottom.name != NONE_VALUE:
-                if left_parts:
-                    left_parts.append(empty_padding)
-                left_parts.append(
-                    text_to_image(
-                        container.get_attribute_str(config.layout.elements.left_bottom),
-                        config.get_font(),
-                        config.get_bold_font(),
-                        is_bold=self.bold_font_lb,
-                        fill=self.font_color_lb,
-                    )
-                )
-            left = concatenate_images(left_parts, Axis.VERTICAL, Align.START)
-            # 填充右边的文字内容
-            right_parts = []
-            if config.layout.elements.right_top.name != NONE_VALUE:
-                right_parts.append(
-                    text_to_image(
-                        container.get_attribute_str(config.layout.elements.right_top),
-                        config.get_font(),
-                        config.get_bold_font(),
-                        is_bold=self.bold_font_rt,
-                        fill=self.font_color_rt,
-                    )
-                )
-            if config.layout.elements.right_bottom.name != NONE_VALUE:
-                if right_parts:
-                    right_parts.append(empty_padding)
-                right_parts.append(
-                    text_to_image(
-                        container.get_attribute_str(
-                            config.layout.elements.right_bottom
-                        ),
-                        config.get_font(),
-                        config.get_bold_font(),
-                        is_bold=self.bold_font_rb,
-                        fill=self.font_color_rb,
-                    )
-                )
-            right = concatenate_images(right_parts, Axis.VERTICAL, Align.START)
-
-        logo = config.load_logo(container.make)
         if self.logo_enable:
+            # logo 按照水印内部高度缩放，同样尺寸的照片复用缩放结果
+            inner_height = watermark.height - 2 * padding[1]
+            scaled_logo = config.load_scaled_logo(container.make, inner_height)
+            logo = ImageBox(scaled_logo) if scaled_logo is not None else None
             if self.is_logo_left():
                 # 如果 logo 在左边
-                append_image_by_side(watermark, [logo, left], padding=(300, 200))
-                append_image_by_side(
-                    watermark, [right], side="right", padding=(300, 200)
+                draw_boxes_by_side(watermark, [logo, left], padding=padding, gap=gap)
+                draw_boxes_by_side(
+                    watermark, [right], side="right", padding=padding, gap=gap
                 )
             else:
                 # 如果 logo 在右边
                 if logo is not None:
-                    # 插入一根线条用于分割 logo 和文字
-                    height = max(logo.height, left.height, right.height)
-                    line = Image.new("RGBA", (20, height), color=GRAY)
+                    # 插入一根线条用于分割 logo 和文字，
+                    # 与原始 logo 和文字中较高的一个等高，
+                    # 超出水印内部高度时与 logo 一样按比例缩小，线条随之变细
+                    raw_logo = config.load_logo(container.make)
+                    height = max(raw_logo.height * scale, left.height, right.height)
+                    line = RectBox(scaled(20), round(height), GRAY)
                 else:
-                    line = LINE_TRANSPARENT.copy()
-                append_image_by_side(watermark, [left], padding=(300, 200))
-                append_image_by_side(
-                    watermark, [logo, line, right], side="right", padding=(300, 200)
+                    line = SpaceBox(scaled(20), scaled(1000))
+                draw_boxes_by_side(watermark, [left], padding=padding, gap=gap)
+                draw_boxes_by_side(
+                    watermark,
+                    [logo, line, right],
+                    side="right",
+                    padding=padding,
+                    gap=gap,
                 )
-                line.close()
         else:
-            append_image_by_side(watermark, [left], padding=(300, 200))
-            append_image_by_side(watermark, [right], side="right", padding=(300, 200))
-        left.close()
-        right.close()
+            draw_boxes_by_side(watermark, [left], padding=padding, gap=gap)
+            draw_boxes_by_side(
+                watermark, [right], side="right", padding=padding, gap=gap
+            )
 
         # 缩放水印的大小
-        watermark = resize_image_with_width(watermark, container.get_width())
-        # 将水印图片放置在原始图片的下方
-        bg = ImageOps.expand(
-            container.get_watermark_img().convert("RGBA"),
-            border=(0, 0, 0, watermark.height),
-            fill=self.bg_color,
-        )
-        fg = ImageOps.expand(
-            watermark, border=(0, container.get_height(), 0, 0), fill=TRANSPARENT
-        )
-        result = Image.alpha_composite(bg, fg)
-        watermark.close()
-        # 更新图片对象
-        result = ImageOps.exif_transpose(result).convert("RGB")
-        container.update_watermark_img(result)
+        if watermark.width != width:
+            watermark = resize_image_with_width(watermark, width)
+        return watermark
 
 
 class MarginProcessor(ProcessorComponent):
+    PADDING_LOCATION = "tlr"
+
+    def get_padding_size(self, size: Size) -> int:
+        return int(self.config.base.white_margin.width * min(size) / 100)
+
+    def plan(self, container: ImageContainer, size: Size) -> tuple[Size, Size]:
+        padding_size = self.get_padding_size(size)
+        return get_padding_geometry(size, padding_size, self.PADDING_LOCATION)
+
+    def render(
+        self, container: ImageContainer, canvas: Image.Image, box: Box, inner_box: Box
+    ) -> None:
+        fill_border(canvas, box, inner_box, self.config.bg_color)
+
     def process(self, container: ImageContainer) -> None:
         config = self.config
-        padding_size = int(
-            config.base.white_margin.width
-            * min(container.get_width(), container.get_height())
-            / 100
-        )
+        padding_size = self.get_padding_size(container.get_watermark_img().size)
         padding_img = padding_image(
-            container.get_watermark_img(), padding_size, "tlr", color=config.bg_color
+            container.get_watermark_img(),
+            padding_size,
+            self.PADDING_LOCATION,
+            color=config.bg_color,
         )
         container.update_watermark_img(padding_img)
 
@@ -263,86 +587,143 @@ class SimpleProcessor(ProcessorComponent):
     def process(self, container: ImageContainer) -> None:
         ratio = 0.16 if container.get_ratio() >= 1 else 0.1
         padding_ratio = 0.5 if container.get_ratio() >= 1 else 0.5
+        height = int(container.get_height() * ratio * padding_ratio)
 
-        first_text = text_to_image(
-            "Shot on",
-            self.config.get_font(),
-            self.config.get_bold_font(),
-            is_bold=False,
-            fill="#212121",
-        )
-        model = text_to_image(
-            container.get_model().replace(r"/", " ").replace(r"_", " "),
-            self.config.get_font(),
-            self.config.get_bold_font(),
-            is_bold=True,
-            fill="#D32F2F",
-        )
-        make = text_to_image(
-            container.get_make().split(" ")[0],
-            self.config.get_font(),
-            self.config.get_bold_font(),
-            is_bold=True,
-            fill="#212121",
-        )
-        first_line = concatenate_images(
-            [first_text, MIDDLE_HORIZONTAL_GAP, model, MIDDLE_HORIZONTAL_GAP, make],
-            Axis.HORIZONTAL,
+        # 先通过字体度量计算文字的高度，按照目标高度缩放字号后直接绘制
+        if self.config.layout.render_at_target_size:
+            text_height = get_text_height(self.config.get_bold_font())
+            scale = height / (text_height * 2 + MIDDLE_VERTICAL_GAP.height)
+        else:
+            scale = 1.0
+        font = self.config.get_font(scale)
+        bold_font = self.config.get_bold_font(scale)
+        use_glyph_atlas = self.config.layout.use_glyph_atlas
+
+        def text(content: str, is_bold: bool, fill: str) -> TextBox:
+            return TextBox(content, font, bold_font, is_bold, fill, use_glyph_atlas)
+
+        horizontal_gap = SpaceBox(max(1, round(MIDDLE_HORIZONTAL_GAP.width * scale)), 1)
+        first_line = RowBox(
+            [
+                text("Shot on", False, "#212121"),
+                horizontal_gap,
+                text(
+                    container.get_model().replace(r"/", " ").replace(r"_", " "),
+                    True,
+                    "#D32F2F",
+                ),
+                horizontal_gap,
+                text(container.get_make().split(" ")[0], True, "#212121"),
+            ],
             Align.END,
         )
-        second_line_text = container.get_param_str()
-        second_line = text_to_image(
-            second_line_text,
-            self.config.get_font(),
-            self.config.get_bold_font(),
-            is_bold=False,
-            fill="#9E9E9E",
-        )
-        image = concatenate_images(
-            [first_line, MIDDLE_VERTICAL_GAP, second_line], Axis.VERTICAL, Align.CENTER
+        second_line = text(container.get_param_str(), False, "#9E9E9E")
+        vertical_gap = SpaceBox(1, max(1, round(MIDDLE_VERTICAL_GAP.height * scale)))
+        column = ColumnBox([first_line, vertical_gap, second_line], Align.CENTER)
+
+        image = None
+        text_size = (column.width, column.height)
+        if not self.config.layout.render_at_target_size:
+            # 按原始字号绘制后整体缩放到目标高度
+            image = Image.new("RGBA", text_size, color=TRANSPARENT)
+            column.draw(image, ImageDraw.Draw(image), 0, 0)
+            image = resize_image_with_height(image, height)
+            text_size = image.size
+        horizontal_padding = int((container.get_width() - text_size[0]) / 2)
+        vertical_padding = int((container.get_height() * ratio - text_size[1]) / 2)
+
+        # 文字直接绘制到与照片模式相同的画布上
+        photo = container.get_watermark_img()
+        watermark_width = text_size[0] + horizontal_padding * 2
+        watermark_height = text_size[1] + vertical_padding * 2
+        width = max(photo.width, watermark_width)
+        watermark_img = new_canvas(
+            photo.mode, (width, photo.height + watermark_height), color="white"
         )
-        height = container.get_height() * ratio * padding_ratio
-        image = resize_image_with_height(image, int(height))
-        horizontal_padding = int((container.get_width() - image.width) / 2)
-        vertical_padding = int((container.get_height() * ratio - image.height) / 2)
-
-        watermark = ImageOps.expand(
-            image, (horizontal_padding, vertical_padding), fill=TRANSPARENT
-        )
-        bg = Image.new("RGBA", watermark.size, color="white")
-        bg = Image.alpha_composite(bg, watermark)
-
-        watermark_img = concatenate_images(
-            [container.get_watermark_img(), bg], Axis.VERTICAL, Align.END
+        watermark_img.paste(photo, (width - photo.width, 0))
+        position = (
+            width - watermark_width + horizontal_padding,
+            photo.height + vertical_padding,
         )
+        if image is None:
+            column.draw(watermark_img, ImageDraw.Draw(watermark_img), *position)
+        else:
+            watermark_img.paste(image, position, mask=image)
+            image.close()
         container.update_watermark_img(watermark_img)
 
 
 class PaddingToOriginalRatioProcessor(ProcessorComponent):
-    def process(self, container: ImageContainer) -> None:
+    def get_padding(self, container: ImageContainer, size: Size) -> Size:
+        width, height = size
         original_ratio = container.get_original_ratio()
         ratio = container.get_ratio()
         if original_ratio > ratio:
             # 如果原始比例大于当前比例，说明宽度大于高度，需要填充高度
-            padding_size = int(
-                container.get_width() / original_ratio - container.get_height()
-            )
-            padding_img = ImageOps.expand(
-                container.get_watermark_img(), (0, padding_size), fill="white"
-            )
+            return 0, int(width / original_ratio - height)
         else:
             # 如果原始比例小于当前比例，说明高度大于宽度，需要填充宽度
-            padding_size = int(
-                container.get_height() * original_ratio - container.get_width()
-            )
-            padding_img = ImageOps.expand(
-                container.get_watermark_img(), (padding_size, 0), fill="white"
-            )
+            return int(height * original_ratio - width), 0
+
+    def plan(self, container: ImageContainer, size: Size) -> tuple[Size, Size] | None:
+        padding = self.get_padding(container, size)
+        if min(padding) < 0:
+            # 需要裁剪图片时不进行规划
+            return None
+        new_size = (size[0] + padding[0] * 2, size[1] + padding[1] * 2)
+        return new_size, padding
+
+    def render(
+        self, container: ImageContainer, canvas: Image.Image, box: Box, inner_box: Box
+    ) -> None:
+        fill_border(canvas, box, inner_box, "white")
+
+    def process(self, container: ImageContainer) -> None:
+        padding = self.get_padding(container, container.get_watermark_img().size)
+        image = container.get_watermark_img()
+        padding_img = ImageOps.expand(
+            image, padding, fill=get_color("white", image.mode)
+        )
         container.update_watermark_img(padding_img)
 
 
 PADDING_PERCENT_IN_BACKGROUND = 0.18
 GAUSSIAN_KERNEL_RADIUS = 35
+BACKGROUND_WHITE_BLEND = 0.1
+# 缩小后模糊时图片长边的下限。图片较小时按模糊半径缩小过多，阴影等细节的误差明显
+MIN_BLUR_SIZE = 1024
+
+
+def blur_background(
+    container: ImageContainer,
+    image: Image.Image,
+    size: tuple[int, int],
+    quality: int,
+) -> Image.Image:
+    """
+    生成模糊背景：先缩小图片，在低分辨率下用等效半径模糊，再放大到目标尺寸
+    :param container: 图片容器
+    :param image: 需要模糊的图片，基础图片的模糊结果会被缓存
+    :param size: 背景尺寸
+    :param quality: 低分辨率下的模糊半径，越大越接近全尺寸模糊，速度越慢
+    :return: 与白色混合后的模糊背景
+    """
+    # 模糊半径随解码缩放比例调整，保证缩小输出时模糊程度一致
+    radius = GAUSSIAN_KERNEL_RADIUS * container.get_scale()
+    scale = min(1.0, max(quality / radius, MIN_BLUR_SIZE / max(image.size)))
+    blurred = container.get_blurred_img(radius, scale, image)
+    # 与白色按比例混合，在低分辨率下进行以减少计算量，CMYK 中 0 为白色
+    if blurred.mode == "CMYK":
+        background = blurred.point(lambda v: v * (1 - BACKGROUND_WHITE_BLEND))
+    else:
+        background = blurred.point(
+            lambda v: v * (1 - BACKGROUND_WHITE_BLEND) + 255 * BACKGROUND_WHITE_BLEND
+        )
+    if image is not container.get_img():
+        blurred.close()
+    resized = background.resize(size, Image.BICUBIC)
+    background.close()
+    return resized
 
 
 class BackgroundBlurProcessor(ProcessorComponent):
@@ -350,17 +731,15 @@ class BackgroundBlurProcessor(ProcessorComponent):
     LAYOUT_NAME = "背景模糊"
 
     def process(self, container: ImageContainer) -> None:
-        background = container.get_watermark_img()
-        background = background.filter(
-            ImageFilter.GaussianBlur(radius=GAUSSIAN_KERNEL_RADIUS)
-        )
-        fg = Image.new("RGB", background.size, color=(255, 255, 255))
-        background = Image.blend(background, fg, 0.1)
-        background = background.resize(
+        # 模糊当前阶段的画面，开启阴影等效果时背景中同样包含这些效果
+        background = blur_background(
+            container,
+            container.get_watermark_img(),
             (
                 int(container.get_width() * (1 + PADDING_PERCENT_IN_BACKGROUND)),
                 int(container.get_height() * (1 + PADDING_PERCENT_IN_BACKGROUND)),
-            )
+            ),
+            self.config.base.background_blur.quality,
         )
         background.paste(
             container.get_watermark_img(),
@@ -375,6 +754,7 @@ class BackgroundBlurProcessor(ProcessorComponent):
 class BackgroundBlurWithWhiteBorderProcessor(ProcessorComponent):
     LAYOUT_ID = Layout.BACKGROUND_BLUR_WHITE_BORDER
     LAYOUT_NAME = "背景模糊+白框"
+    BUFFER_COUNT = 2
 
     def process(self, container: ImageContainer) -> None:
         padding_size = int(
@@ -386,18 +766,15 @@ class BackgroundBlurWithWhiteBorderProcessor(ProcessorComponent):
             container.get_watermark_img(), padding_size, "tblr", color="white"
         )
 
-        background = container.get_img()
-        background = background.filter(
-            ImageFilter.GaussianBlur(radius=GAUSSIAN_KERNEL_RADIUS)
-        )
-        background = background.resize(
+        background = blur_background(
+            container,
+            container.get_img(),
             (
                 int(padding_img.width * (1 + PADDING_PERCENT_IN_BACKGROUND)),
                 int(padding_img.height * (1 + PADDING_PERCENT_IN_BACKGROUND)),
-            )
+            ),
+            self.config.base.background_blur.quality,
         )
-        fg = Image.new("RGB", background.size, color=(255, 255, 255))
-        background = Image.blend(background, fg, 0.1)
         background.paste(
             padding_img,
             (
@@ -405,24 +782,14 @@ class BackgroundBlurWithWhiteBorderProcessor(ProcessorComponent):
                 int(padding_img.height * PADDING_PERCENT_IN_BACKGROUND / 2),
             ),
         )
+        release_canvas(padding_img)
         container.update_watermark_img(background)
 
 
-class PureWhiteMarginProcessor(ProcessorComponent):
+class PureWhiteMarginProcessor(MarginProcessor):
     LAYOUT_ID = Layout.PURE_WHITE_MARGIN
     LAYOUT_NAME = "白色边框"
-
-    def process(self, container: ImageContainer) -> None:
-        config = self.config
-        padding_size = int(
-            config.base.white_margin.width
-            * min(container.get_width(), container.get_height())
-            / 100
-        )
-        padding_img = padding_image(
-            container.get_watermark_img(), padding_size, "tlrb", color=config.bg_color
-        )
-        container.update_watermark_img(padding_img)
+    PADDING_LOCATION = "tlrb"
 
 
 LAYOUT_PROCESSORS = {
@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 同一个任务最多被领取的次数，超过后视为失败，避免导致进程崩溃的照片反复被领取
+MAX_ATTEMPTS = 3
+# 没有可领取的任务时，重新检查队列的间隔（秒）
+POLL_INTERVAL = 1.0
+
+
+class LeaseLostError(RuntimeError):
+    """
+    租约已经过期并被其他节点收回
+    """
+
+
+@dataclass(frozen=True)
+class Lease:
+    """
+    一个已领取的任务
+    """
+
+    task_id: str
+    # 照片相对于输入目录的路径
+    path: str
+    # 租约文件的名称：任务 ID 加上持有者
+    name: str
+
+
+class LeaseQueue:
+    """
+    基于共享目录的任务队列，多台机器挂载同一个目录即可共同处理，不需要额外的服务。
+
+    目录结构：
+    - populating、ready：正在写入任务和写入完成的标记文件
+    - tasks/：等待领取的任务，每个任务一个文件
+    - leases/：已被领取的任务，文件名中带有持有者，修改时间即最后一次续约的时间
+    - reclaiming/：正在检查是否过期的租约，检查结束后放回 leases/ 或者 tasks/
+    - done/、failed/：已完成和失败的任务
+
+    领取任务就是把任务文件原子地重命名到 leases/ 中，同一时刻只有一个节点能够成功。
+    持有者定期更新租约文件的修改时间，超过 lease_timeout 没有续约的租约
+    会被任意节点重命名回 tasks/，由其他节点重新领取
+    """
+
+    def __init__(self, directory: str | Path, lease_timeout: float = 60):
+        """
+        :param directory: 共享的队列目录
+        :param lease_timeout: 租约的有效期（秒）
+        """
+        self.directory = Path(directory)
+        self.lease_timeout = lease_timeout
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.tasks_dir = self.directory / "tasks"
+        self.leases_dir = self.directory / "leases"
+        self.reclaim_dir = self.directory / "reclaiming"
+        self.done_dir = self.directory / "done"
+        self.failed_dir = self.directory / "failed"
+        self.tmp_dir = self.directory / "tmp"
+        for d in (
+            self.tasks_dir,
+            self.leases_dir,
+            self.reclaim_dir,
+            self.done_dir,
+            self.failed_dir,
+            self.tmp_dir,
+        ):
+            d.mkdir(parents=True, exist_ok=True)
+        # 当前节点持有的租约
+        self._held: dict[str, Lease] = {}
+        # 上一次列出的等待领取的任务，领取完后才重新列出目录
+        self._candidates: deque[str] = deque()
+        self._lock = threading.Lock()
+
+    def _write_atomic(self, target: Path, data: dict) -> None:
+        # 先写入临时文件再重命名，其他节点不会读到写了一半的文件
+        tmp = self.tmp_dir / f"{target.name}.{self.owner}"
+        tmp.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp, target)
+
+    def populate(self, paths: Iterable[str]) -> bool:
+        """
+        写入任务。多个节点同时调用时只有一个节点写入，其他节点等待写入完成。
+        写入的节点定期更新标记文件的修改时间，超过 lease_timeout 没有更新时，
+        说明它已经退出，由等待的节点接手
+        :param paths: 照片相对于输入目录的路径，只有写入任务的节点才会遍历
+        :return: 当前节点是否写入了任务
+        :raise LeaseLostError: 写入停顿超过有效期，已由其他节点接手
+        """
+        marker = self.directory / "populating"
+        ready = self.directory / "ready"
+        while True:
+            try:
+                fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                pass
+            if ready.exists():
+                return False
+            try:
+                if self._server_time() - marker.stat().st_mtime > self.lease_timeout:
+                    # 移走过期的标记文件，重新竞争写入
+                    os.rename(marker, self.tmp_dir / f"populating.{self.owner}")
+                    logger.warning("写入任务的节点已经退出，重新写入任务")
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(POLL_INTERVAL)
+        inode = os.fstat(fd).st_ino
+        os.close(fd)
+
+        def owns_marker() -> bool:
+            try:
+                return marker.stat().st_ino == inode
+            except FileNotFoundError:
+                return False
+
+        def touch_marker() -> None:
+            if owns_marker():
+                os.utime(marker)
+
+        # 清除退出的节点写入的部分任务，ready 出现之前没有节点会领取任务
+        for name in os.listdir(self.tasks_dir):
+            (self.tasks_dir / name).unlink(missing_ok=True)
+        with self._every(self.lease_timeout / 3, touch_marker):
+            for index, path in enumerate(paths):
+                if not owns_marker():
+                    raise LeaseLostError("写入任务超过了有效期，已由其他节点接手")
+                task_id = f"{index:08d}"
+                self._write_atomic(
+                    self.tasks_dir / task_id, {"path": path, "attempts": 0}
+                )
+            if not owns_marker():
+                raise LeaseLostError("写入任务超过了有效期，已由其他节点接手")
+            ready.touch()
+        return True
+
+    def claim(self) -> Lease | None:
+        """
+        领取一个任务
+        :return: 租约，当前没有可以领取的任务时返回 None
+        """
+        if not self._candidates:
+            self._candidates.extend(sorted(os.listdir(self.tasks_dir)))
+        while self._candidates:
+            task_id = self._candidates.popleft()
+            task_path = self.tasks_dir / task_id
+            lease_path = self.leases_dir / f"{task_id}.{self.owner}"
+            try:
+                # 收回的任务保留着旧的修改时间，先更新，避免领取后立即被判定为过期
+                os.utime(task_path)
+                os.rename(task_path, lease_path)
+            except FileNotFoundError:
+                # 被其他节点抢先领取
+                continue
+            try:
+                data = json.loads(lease_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                logger.error(f"无法读取任务 {task_id} : {e}")
+                os.replace(lease_path, self.failed_dir / task_id)
+                continue
+            data["attempts"] += 1
+            if data["attempts"] > MAX_ATTEMPTS:
+                logger.error(f"{data['path']} 已经领取 {MAX_ATTEMPTS} 次仍未完成")
+                os.replace(lease_path, self.failed_dir / task_id)
+                continue
+            self._write_atomic(lease_path, data)
+            lease = Lease(task_id, data["path"], lease_path.name)
+            with self._lock:
+                self._held[lease.name] = lease
+            return lease
+        return None
+
+    def iter_claims(self) -> Iterator[Lease]:
+        """
+        依次领取任务，直到没有可以领取的任务
+        """
+        while True:
+            lease = self.claim()
+            if lease is None:
+                return
+            yield lease
+
+    def _apply(self, lease: Lease, action: Callable[[Path], object]) -> bool:
+        """
+        对租约文件执行操作
+        :param action: 接收租约文件路径的操作，文件不存在时抛出 FileNotFoundError
+        :return: 租约文件是否存在，不存在说明已被其他节点收回
+        """
+        path = self.leases_dir / lease.name
+        try:
+            action(path)
+            return True
+        except FileNotFoundError:
+            pass
+        # 其他节点可能正在检查这个租约是否过期，等它放回后再试一次
+        staging = self.reclaim_dir / lease.name
+        deadline = time.monotonic() + POLL_INTERVAL
+        while staging.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        try:
+            action(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def renew(self) -> None:
+        """
+        为当前节点持有的所有租约续约
+        """
+        with self._lock:
+            leases = list(self._held.values())
+        for lease in leases:
+            if not self._apply(lease, os.utime):
+                logger.warning(f"{lease.path} 的租约已过期，已被其他节点收回")
+                with self._lock:
+                    self._held.pop(lease.name, None)
+
+    def heartbeat(self) -> contextlib.AbstractContextManager[None]:
+        """
+        在后台线程中定期续约
+        """
+        return self._every(self.lease_timeout / 3, self.renew)
+
+    @contextlib.contextmanager
+    def _every(self, interval: float, callback: Callable[[], None]) -> Iterator[None]:
+        # 在后台线程中每隔 interval 秒调用一次 callback
+        stop = threading.Event()
+
+        def run() -> None:
+            while not stop.wait(interval):
+                callback()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _release(self, lease: Lease, target: Path) -> None:
+        with self._lock:
+            self._held.pop(lease.name, None)
+        if not self._apply(lease, lambda path: os.replace(path, target)):
+            raise LeaseLostError(f"{lease.path} 的租约已被其他节点收回")
+
+    def release(self, lease: Lease) -> None:
+        """
+        把领取后没有开始处理的任务放回等待领取的任务中，不计入领取次数
+        :raise LeaseLostError: 租约已被其他节点收回
+        """
+
+        def restore_attempts(path: Path) -> None:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            data["attempts"] -= 1
+            self._write_atomic(path, data)
+
+        if not self._apply(lease, restore_attempts):
+            with self._lock:
+                self._held.pop(lease.name, None)
+            raise LeaseLostError(f"{lease.path} 的租约已被其他节点收回")
+        self._release(lease, self.tasks_dir / lease.task_id)
+
+    def complete(self, lease: Lease) -> None:
+        """
+        标记任务完成
+        :raise LeaseLostError: 租约已被其他节点收回，这张照片可能会被再处理一次
+        """
+        self._release(lease, self.done_dir / lease.task_id)
+
+    def fail(self, lease: Lease, error: BaseException) -> None:
+        """
+        标记任务失败，失败的任务不会被重新领取
+        """
+        self._release(lease, self.failed_dir / lease.task_id)
+        with contextlib.suppress(OSError):
+            self.failed_dir.joinpath(f"{lease.task_id}.error").write_text(
+                f"{lease.path}: {error!r}", encoding="utf-8"
+            )
+
+    def _server_time(self) -> float:
+        # 租约的修改时间来自文件服务器的时钟，通过更新一个文件获取同一个时钟的当前时间
+        probe = self.tmp_dir / f"clock.{self.owner}"
+        probe.touch()
+        return probe.stat().st_mtime
+
+    def reclaim_expired(self) -> int:
+        """
+        把超过有效期没有续约的租约放回等待领取的任务中
+        :return: 收回的租约数量
+        """
+        now = self._server_time()
+        reclaimed = 0
+        for name in os.listdir(self.leases_dir):
+            lease_path = self.leases_dir / name
+            staging = self.reclaim_dir / name
+            try:
+                if now - lease_path.stat().st_mtime <= self.lease_timeout:
+                    continue
+                # 持有者可能在检查之后刚好续约，先移到暂存目录使它无法再续约，
+                # 再检查一次修改时间，仍然过期才放回等待领取的任务中
+                os.rename(lease_path, staging)
+            except FileNotFoundError:
+                continue
+            if now - staging.stat().st_mtime <= self.lease_timeout:
+                os.rename(staging, lease_path)
+                continue
+            os.rename(staging, self.tasks_dir / name.split(".", 1)[0])
+            reclaimed += 1
+            logger.warning(f"收回过期的租约：{name}")
+        for name in os.listdir(self.reclaim_dir):
+            staging = self.reclaim_dir / name
+            try:
+                # 暂存的租约会立即被放回，停留超过有效期说明检查它的节点已经退出。
+                # 移动文件会更新 ctime，因此 ctime 就是暂存的时间
+                if now - staging.stat().st_ctime > self.lease_timeout:
+                    os.rename(staging, self.tasks_dir / name.split(".", 1)[0])
+                    reclaimed += 1
+                    logger.warning(f"收回暂存的租约：{name}")
+            except FileNotFoundError:
+                continue
+        return reclaimed
+
+    def is_finished(self) -> bool:
+        """
+        所有任务是否都已经完成或失败
+        """
+        return not any(
+            os.listdir(d) for d in (self.tasks_dir, self.leases_dir, self.reclaim_dir)
+        )
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+ATLAS_MAGIC = b"WMLOGO01"
+ATLAS_HEADER = struct.Struct("<8sI")
+ATLAS_ALIGNMENT = 64
+ATLAS_DIRECTORY = Path(tempfile.gettempdir(), "watermarker")
+
+# 每个进程中已映射的图集，键为 logo 目录
+_atlases: dict[Path, LogoAtlas] = {}
+
+
+def _align(offset: int) -> int:
+    return (offset + ATLAS_ALIGNMENT - 1) // ATLAS_ALIGNMENT * ATLAS_ALIGNMENT
+
+
+def _list_logo_files(directory: Path) -> list[Path]:
+    return sorted(p for p in directory.iterdir() if p.is_file())
+
+
+def get_directory_signature(directory: Path) -> str:
+    """
+    根据目录中文件的名称、大小和修改时间计算签名，任何文件变化都会改变签名
+    :param directory: logo 目录
+    :return: 签名字符串
+    """
+    digest = hashlib.sha1()
+    for file_path in _list_logo_files(directory):
+        stat = file_path.stat()
+        digest.update(
+            f"{file_path.name}:{stat.st_size}:{stat.st_mtime_ns}\0".encode("utf-8")
+        )
+    return digest.hexdigest()[:16]
+
+
+def _get_atlas_prefix(directory: Path) -> str:
+    key = hashlib.sha1(str(directory.resolve()).encode("utf-8")).hexdigest()[:16]
+    return f"logos-{key}-"
+
+
+def get_atlas_path(directory: Path) -> Path:
+    """
+    图集文件名包含目录内容的签名，目录变化后会自动使用新的图集文件
+    """
+    signature = get_directory_signature(directory)
+    return ATLAS_DIRECTORY.joinpath(f"{_get_atlas_prefix(directory)}{signature}.atlas")
+
+
+def build_logo_atlas(directory: Path, target_path: Path) -> Path:
+    """
+    将 logo 目录打包为一个图集文件：文件头 + JSON 索引 + 按顺序排列的 RGBA 原始数据
+    :param directory: logo 目录
+    :param target_path: 图集文件路径
+    :return: 图集文件路径
+    """
+    index = {}
+    images = []
+    for file_path in _list_logo_files(directory):
+        try:
+            with Image.open(file_path) as img:
+                rgba = img.convert("RGBA")
+        except (UnidentifiedImageError, OSError) as e:
+            logger.warning(f"跳过无法解码的 logo：{file_path} : {e}")
+            continue
+        index[file_path.name] = {"size": list(rgba.size)}
+        images.append((file_path.name, rgba))
+
+    # 偏移量相对于数据区开头，并按 ATLAS_ALIGNMENT 对齐
+    offset = 0
+    for name, rgba in images:
+        index[name]["offset"] = offset
+        offset = _align(offset + rgba.width * rgba.height * 4)
+    index_bytes = json.dumps(index).encode("utf-8")
+    data_start = _align(ATLAS_HEADER.size + len(index_bytes))
+
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    # 先写入临时文件再原子替换，避免多个进程同时构建时读到不完整的图集
+    fd, tmp_name = tempfile.mkstemp(dir=target_path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(ATLAS_HEADER.pack(ATLAS_MAGIC, len(index_bytes)))
+            f.write(index_bytes)
+            for name, rgba in images:
+                f.seek(data_start + index[name]["offset"])
+                f.write(rgba.tobytes())
+                rgba.close()
+        os.replace(tmp_name, target_path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    logger.info(f"已生成 logo 图集：{target_path}")
+    return target_path
+
+
+class LogoAtlas:
+    """
+    通过 mmap 映射的 logo 图集，logo 以零拷贝的只读 Image 对象返回
+    """
+
+    def __init__(self, directory: Path, path: Path):
+        self.directory = directory.resolve()
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_size = ATLAS_HEADER.unpack_from(self._mmap, 0)
+        if magic != ATLAS_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"无效的 logo 图集：{path}")
+        start = ATLAS_HEADER.size
+        self.index: dict[str, dict] = json.loads(self._mmap[start : start + index_size])
+        self._data_start = _align(start + index_size)
+
+    def get(self, name: str) -> Image.Image | None:
+        """
+        根据文件名获取 logo
+        :param name: logo 文件名
+        :return: logo 图片对象，不存在时返回 None
+        """
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        width, height = entry["size"]
+        offset = self._data_start + entry["offset"]
+        buffer = memoryview(self._mmap)[offset : offset + width * height * 4]
+        return Image.frombuffer("RGBA", (width, height), buffer, "raw", "RGBA", 0, 1)
+
+    def close(self) -> None:
+        """
+        关闭内存映射
+        """
+        try:
+            self._mmap.close()
+        except BufferError:
+            # 仍有 logo 图片引用映射的内存，这些图片释放后由垃圾回收关闭
+            logger.debug(f"logo 图集仍在使用，延迟关闭：{self.path}")
+
+    def open(self, path: Path) -> Image.Image | None:
+        """
+        获取指定路径的 logo，路径不在图集目录中时返回 None
+        """
+        if path.parent.resolve() != self.directory:
+            return None
+        return self.get(path.name)
+
+
+def load_logo_atlas(directory: Path, refresh: bool = False) -> LogoAtlas | None:
+    """
+    获取 logo 目录对应的图集。每个进程只在第一次加载时检查目录中的文件，
+    refresh 为真时重新检查，文件发生变化时重新构建图集
+    :param directory: logo 目录
+    :param refresh: 是否重新检查目录中的文件
+    :return: 图集对象，目录不存在或构建失败时返回 None
+    """
+    if not directory.is_dir():
+        return None
+    key = directory.resolve()
+    atlas = _atlases.get(key)
+    if atlas is not None and not refresh:
+        return atlas
+    try:
+        atlas_path = get_atlas_path(directory)
+        if atlas is not None and atlas.path == atlas_path:
+            return atlas
+        if not atlas_path.exists():
+            build_logo_atlas(directory, atlas_path)
+            _remove_stale_atlases(directory, atlas_path)
+        new_atlas = LogoAtlas(directory, atlas_path)
+    except (OSError, ValueError) as e:
+        logger.error(f"load_logo_atlas error: {directory} : {e}")
+        return None
+    if atlas is not None:
+        atlas.close()
+    _atlases[key] = new_atlas
+    return new_atlas
+
+
+def _remove_stale_atlases(directory: Path, current: Path) -> None:
+    # 删除同一目录的旧图集，仍被其他进程映射的文件可能删除失败，忽略即可
+    for path in current.parent.glob(f"{_get_atlas_prefix(directory)}*.atlas"):
+        if path == current:
+            continue
+        try:
+            path.unlink()
+        except OSError:
+            pass
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import logging
+import re
+import struct
+from dataclasses import dataclass
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Sequence
+
+from dateutil import parser
+from PIL import Image, UnidentifiedImageError
+
+from .constants import DEFAULT_VALUE
+from .utils import (
+    extract_attribute,
+    extract_gps_info,
+    extract_gps_lat_and_long,
+    get_exif,
+    get_exif_batch,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ExifId(Enum):
+    CAMERA_MODEL = "CameraModelName"
+    CAMERA_MAKE = "Make"
+    LENS_MODEL = ["LensModel", "Lens", "LensID"]
+    LENS_MAKE = "LensMake"
+    DATETIME = "DateTimeOriginal"
+    FOCAL_LENGTH = "FocalLength"
+    FOCAL_LENGTH_IN_35MM_FILM = "FocalLengthIn35mmFormat"
+    F_NUMBER = "FNumber"
+    ISO = "ISO"
+    EXPOSURE_TIME = "ExposureTime"
+    SHUTTER_SPEED_VALUE = "ShutterSpeedValue"
+    ORIENTATION = "Orientation"
+
+
+PATTERN = re.compile(r"(\d+)\.")  # 匹配小数
+
+
+def get_datetime(exif) -> datetime:
+    dt = datetime.now()
+    try:
+        dt = parser.parse(
+            extract_attribute(
+                exif, ExifId.DATETIME.value, default_value=str(datetime.now())
+            )
+        )
+    except ValueError:
+        logger.info(
+            f"Error: 时间格式错误：{extract_attribute(exif, ExifId.DATETIME.value)}"
+        )
+    return dt
+
+
+def get_focal_length(exif: dict[str, str]) -> tuple[str, str]:
+    focal_length = DEFAULT_VALUE
+    focal_length_in_35mm_film = DEFAULT_VALUE
+
+    try:
+        focal_lengths = PATTERN.findall(
+            extract_attribute(exif, ExifId.FOCAL_LENGTH.value)
+        )
+        try:
+            focal_length = focal_lengths[0] if focal_length else DEFAULT_VALUE
+        except IndexError as e:
+            logger.error(f"ValueError: 不存在焦距：{focal_lengths} : {e}")
+        try:
+            focal_length_in_35mm_film: str = (
+                focal_lengths[1] if focal_length else DEFAULT_VALUE
+            )
+        except IndexError as e:
+            logger.error(f"ValueError: 不存在 35mm 焦距：{focal_lengths} : {e}")
+    except Exception as e:
+        focal_length_value = extract_attribute(exif, ExifId.FOCAL_LENGTH.value)
+        logger.error(f"KeyError: 焦距转换错误：{focal_length_value} : {e}")
+
+    return focal_length, focal_length_in_35mm_film
+
+
+def get_geo_info(exif: dict[str, str]) -> str:
+    if "GPSPosition" in exif:
+        return " ".join(extract_gps_info(exif["GPSPosition"]))
+    if "GPSLatitude" in exif and "GPSLongitude" in exif:
+        return " ".join(
+            extract_gps_lat_and_long(exif["GPSLatitude"], exif["GPSLongitude"])
+        )
+    return "无"
+
+
+# 序列化格式：版本号、原图宽高，随后是按字段顺序排列的带长度前缀的 UTF-8 字符串
+META_VERSION = 1
+META_HEADER = struct.Struct("<BII")
+META_STRING_LENGTH = struct.Struct("<H")
+META_STRING_MAX_BYTES = 2**16 - 1
+META_STRING_FIELDS = (
+    "make",
+    "model",
+    "lens_make",
+    "lens_model",
+    "focal_length",
+    "focal_length_in_35mm_film",
+    "f_number",
+    "exposure_time",
+    "iso",
+    "orientation",
+    "geo_info",
+)
+
+
+@dataclass(frozen=True, slots=True)
+class PhotoMeta:
+    """
+    照片元数据，只保留生成水印需要的规范化字段，可以低成本地在进程之间传递和缓存
+    """
+
+    make: str
+    model: str
+    lens_make: str
+    lens_model: str
+    date: datetime
+    focal_length: str
+    focal_length_in_35mm_film: str
+    f_number: str
+    exposure_time: str
+    iso: str
+    # 图像方向，没有方向信息时为空字符串
+    orientation: str
+    geo_info: str
+    width: int
+    height: int
+
+    @classmethod
+    def from_exif(cls, exif: dict[str, str], width: int, height: int) -> PhotoMeta:
+        """
+        从 exiftool 输出的原始 EXIF 中提取元数据
+        :param exif: 原始 EXIF 字典
+        :param width: 原图宽度
+        :param height: 原图高度
+        :return: 元数据对象
+        """
+        focal_length, focal_length_in_35mm_film = get_focal_length(exif)
+        return cls(
+            make=extract_attribute(exif, ExifId.CAMERA_MAKE.value),
+            model=extract_attribute(exif, ExifId.CAMERA_MODEL.value),
+            lens_make=extract_attribute(exif, ExifId.LENS_MAKE.value),
+            lens_model=extract_attribute(exif, *ExifId.LENS_MODEL.value),
+            date=get_datetime(exif),
+            focal_length=focal_length,
+            focal_length_in_35mm_film=focal_length_in_35mm_film,
+            f_number=extract_attribute(
+                exif, ExifId.F_NUMBER.value, default_value=DEFAULT_VALUE
+            ),
+            exposure_time=extract_attribute(
+                exif,
+                ExifId.EXPOSURE_TIME.value,
+                default_value=DEFAULT_VALUE,
+                suffix="s",
+            ),
+            iso=extract_attribute(exif, ExifId.ISO.value, default_value=DEFAULT_VALUE),
+            orientation=exif.get(ExifId.ORIENTATION.value, ""),
+            geo_info=get_geo_info(exif),
+            width=width,
+            height=height,
+        )
+
+    @classmethod
+    def read(cls, path: Path) -> PhotoMeta:
+        """
+        读取照片的元数据，只读取文件头，不解码像素
+        :param path: 照片路径
+        :return: 元数据对象
+        """
+        with Image.open(path) as img:
+            width, height = img.size
+        return cls.from_exif(get_exif(path), width, height)
+
+    @classmethod
+    def read_many(cls, paths: Sequence[Path]) -> dict[Path, PhotoMeta]:
+        """
+        批量读取多张照片的元数据，exiftool 按批启动，比逐张读取快得多
+        :param paths: 照片路径列表
+        :return: 照片路径到元数据的映射，无法打开的照片不包含在结果中
+        """
+        exifs = get_exif_batch(paths)
+        metas = {}
+        for path in paths:
+            try:
+                with Image.open(path) as img:
+                    width, height = img.size
+            except (
+                UnidentifiedImageError,
+                OSError,
+                Image.DecompressionBombError,
+            ) as e:
+                # 超过像素上限的照片也没有元数据，由工作进程自己读取
+                logger.warning(f"无法读取图片尺寸：{path} : {e}")
+                continue
+            metas[path] = cls.from_exif(exifs.get(path, {}), width, height)
+        return metas
+
+    @property
+    def camera_key(self) -> tuple[str, str, str]:
+        """
+        相机和镜头的组合，同一组合的照片使用相同的 logo 和水印文字
+        """
+        return self.make, self.model, self.lens_model
+
+    def to_bytes(self) -> bytes:
+        """
+        序列化为紧凑的二进制格式
+        """
+        parts = [META_HEADER.pack(META_VERSION, self.width, self.height)]
+        for value in (
+            *(getattr(self, name) for name in META_STRING_FIELDS),
+            self.date.isoformat(),
+        ):
+            data = value.encode("utf-8")
+            if len(data) > META_STRING_MAX_BYTES:
+                # 在字符边界处截断，不能留下半个多字节字符
+                data = data[:META_STRING_MAX_BYTES].decode("utf-8", "ignore")
+                data = data.encode("utf-8")
+            parts.append(META_STRING_LENGTH.pack(len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> PhotoMeta:
+        """
+        从 to_bytes 的结果中恢复元数据
+        """
+        version, width, height = META_HEADER.unpack_from(data, 0)
+        if version != META_VERSION:
+            raise ValueError(f"不支持的元数据版本：{version}")
+        offset = META_HEADER.size
+        values = []
+        for _ in range(len(META_STRING_FIELDS) + 1):
+            (length,) = META_STRING_LENGTH.unpack_from(data, offset)
+            offset += META_STRING_LENGTH.size
+            values.append(data[offset : offset + length].decode("utf-8"))
+            offset += length
+        *strings, date = values
+        return cls(
+            **dict(zip(META_STRING_FIELDS, strings)),
+            date=datetime.fromisoformat(date),
+            width=width,
+            height=height,
+        )
+
+    def __reduce__(self):
+        # 跨进程传递时使用紧凑的二进制格式
+        return PhotoMeta.from_bytes, (self.to_bytes(),)
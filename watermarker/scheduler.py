@@ -0,0 +1,781 @@
+from __future__ import annotations
+
+import heapq
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from multiprocessing.connection import wait as wait_connections
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Hashable,
+    Iterable,
+    Iterator,
+    Sequence,
+    TypeVar,
+)
+
+from PIL import Image, UnidentifiedImageError
+
+from .buffer_pool import MAX_POOLED_BYTES, PoolStats, get_buffer_pool
+
+if TYPE_CHECKING:
+    from .image_processor import ProcessorChain
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T", bound=Hashable)
+
+MAX_WORKERS = 5
+# Pillow 中 RGB 图片每个像素占用 4 个字节
+BYTES_PER_PIXEL = 4
+# 排在前面的大任务无法提交时，最多向后查找多少个任务
+ADMISSION_LOOKAHEAD = 64
+# 按分组分配任务时，每个工作进程平均同时分到的任务数，
+# 越多越不容易因为没有自己的任务而空闲
+AFFINITY_QUEUE_DEPTH = 4
+# 工作进程排队的任务不少于该数量时，空闲的进程才会帮它执行
+AFFINITY_STEAL_BACKLOG = 2
+# 小图合并成批次时，每批的目标耗时（秒）、初始大小、最小和最大大小
+TARGET_BATCH_SECONDS = 0.5
+INITIAL_BATCH_SIZE = 8
+MIN_BATCH_SIZE = 2
+MAX_BATCH_SIZE = 64
+# 对象无法被 pickle 时可能抛出的异常
+PICKLING_ERRORS = (pickle.PicklingError, TypeError, AttributeError)
+
+
+def read_image_size(path: Path) -> tuple[int, int] | None:
+    """
+    只读取文件头获取图片尺寸，不解码像素
+    :param path: 图片路径
+    :return: (宽, 高)，无法识别时返回 None
+    """
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        logger.warning(f"无法读取图片尺寸：{path} : {e}")
+        return None
+
+
+def read_image_sizes(paths: Sequence[Path]) -> dict[Path, tuple[int, int]]:
+    """
+    读取多张图片的尺寸，参见 read_image_size
+    :param paths: 图片路径列表
+    :return: 图片路径到 (宽, 高) 的映射，无法识别的图片不包含在结果中
+    """
+    sizes = {}
+    for path in paths:
+        size = read_image_size(path)
+        if size is not None:
+            sizes[path] = size
+    return sizes
+
+
+def estimate_task_memory(
+    processor_chains: Sequence[ProcessorChain], size: tuple[int, int] | None
+) -> int:
+    """
+    估算处理一张照片的峰值内存：按最大输出尺寸解码的基础图片，
+    加上处理器链同时持有的全尺寸图片。缓冲池中的空闲画布属于工作进程，
+    参见 get_task_budget
+    :param processor_chains: 这张照片要执行的处理器链
+    :param size: 照片的原始尺寸，参见 read_image_size
+    :return: 估算的字节数，尺寸未知时返回 0
+    """
+    if size is None:
+        return 0
+    width, height = size
+    pixels = width * height
+    sizes = [o.size for chain in processor_chains for o in chain.config.get_outputs()]
+    if None not in sizes:
+        scale = min(1.0, max(sizes) / max(width, height))
+        pixels = int(pixels * scale * scale)
+    buffers = max(chain.get_buffer_count() for chain in processor_chains)
+    return pixels * BYTES_PER_PIXEL * (1 + buffers)
+
+
+def get_task_budget(memory_budget_mb: int | None, workers: int) -> int | None:
+    """
+    计算可以分配给正在处理的照片的内存预算。每个工作进程的缓冲池最多保留
+    MAX_POOLED_BYTES 的空闲画布，与同时处理的照片数量无关，预先从总预算中扣除
+    :param memory_budget_mb: 配置中的内存预算（MB），为空时不限制
+    :param workers: 工作进程数量
+    :return: 字节数，没有预算时返回 None
+    """
+    if memory_budget_mb is None:
+        return None
+    reserved = workers * MAX_POOLED_BYTES
+    budget = memory_budget_mb * 2**20 - reserved
+    if budget <= 0:
+        logger.warning(
+            f"内存预算不足以容纳 {workers} 个工作进程的缓冲池"
+            f"（{reserved // 2**20} MB），照片将逐张处理"
+        )
+        return 0
+    return budget
+
+
+def run_with_budget(
+    items: Iterable[T],
+    submit: Callable[[T], Future],
+    estimate: Callable[[T], int],
+    budget: int | None,
+    max_in_flight: int = MAX_WORKERS,
+    on_done: Callable[[T, Future], None] | None = None,
+    lookahead: int = ADMISSION_LOOKAHEAD,
+    on_skip: Callable[[T], None] | None = None,
+) -> float:
+    """
+    按照内存预算提交任务，直到所有任务完成。
+    正在执行的任务估算内存之和不超过预算；排在前面的任务放不下时，
+    后面较小的任务可以先提交。单个任务超过预算时，等其他任务结束后单独执行
+    :param items: 任务列表，可以是生成器，只在需要提交任务时才取下一个
+    :param submit: 提交任务，返回 Future
+    :param estimate: 估算任务的峰值内存，没有预算时不调用
+    :param budget: 内存预算（字节），为空时不限制
+    :param max_in_flight: 同时执行的最大任务数
+    :param on_done: 每个任务完成后的回调
+    :param lookahead: 任务放不下时，最多再向后取多少个任务尝试提交，为 0 时不再取新任务
+    :param on_skip: 放不下的任务交给这个回调，不再保留在当前节点，为空时稍后重试
+    :return: 最后一个任务提交的时间，与 time.perf_counter 的结果比较
+    """
+    source = iter(items)
+    # 因为内存预算暂时没有提交的任务
+    pending: deque[T] = deque()
+    last_submitted = time.perf_counter()
+    estimates: dict[T, int] = {}
+    in_flight: dict[Future, tuple[T, int]] = {}
+    used = 0
+    # 队首任务被后面的任务超过的次数
+    head_bypassed = 0
+
+    def admit() -> None:
+        nonlocal used, head_bypassed, last_submitted
+        skipped = []
+        while len(in_flight) < max_in_flight:
+            item = pending.popleft() if pending else next(source, None)
+            if item is None:
+                break
+            if item not in estimates:
+                # 没有预算时不需要估算，避免在主进程中逐个打开图片
+                estimates[item] = estimate(item) if budget is not None else 0
+            cost = estimates[item]
+            if budget is None or not in_flight or used + cost <= budget:
+                in_flight[submit(item)] = (item, cost)
+                used += cost
+                last_submitted = time.perf_counter()
+                head_bypassed = head_bypassed + 1 if skipped else 0
+            else:
+                skipped.append(item)
+                # 队首任务被超过太多次时不再允许插队，避免大任务一直等待
+                if len(skipped) > lookahead or head_bypassed >= lookahead:
+                    break
+        if on_skip is not None:
+            for item in skipped:
+                estimates.pop(item, None)
+                on_skip(item)
+        else:
+            # 没有提交的任务保持原来的顺序
+            pending.extendleft(reversed(skipped))
+
+    admit()
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            item, cost = in_flight.pop(future)
+            used -= cost
+            if on_done is not None:
+                on_done(item, future)
+        admit()
+    return last_submitted
+
+
+def simulate_makespan(costs: Iterable[int], workers: int = MAX_WORKERS) -> int:
+    """
+    按顺序把任务交给最先空闲的工作进程，估算全部任务完成的时间
+    :param costs: 按提交顺序排列的任务耗时
+    :param workers: 工作进程数量
+    :return: 与 costs 单位相同的总耗时
+    """
+    finish_times = [0] * workers
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+
+def interleave_groups(
+    items: Sequence[Path], key: Callable[[Path], Hashable]
+) -> list[Path]:
+    """
+    按分组轮流排列任务，使同时提交的任务分属不同的分组，可以分配给各自的工作进程
+    :param items: 任务列表
+    :param key: 获取任务的分组
+    :return: 重新排列的任务列表，同一分组内保持原来的顺序
+    """
+    groups: dict[Hashable, deque[Path]] = defaultdict(deque)
+    for item in items:
+        groups[key(item)].append(item)
+    result = []
+    queues = list(groups.values())
+    while queues:
+        for queue in queues:
+            result.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return result
+
+
+def assign_lanes(
+    items: Sequence[Path],
+    key: Callable[[Path], Hashable],
+    lanes: int = MAX_WORKERS,
+    weight: Callable[[Path], int] | None = None,
+) -> dict[Path, int]:
+    """
+    按分组把任务分配到各个工作进程，同一分组尽量只在一个进程中执行。
+    超过平均工作量的分组拆成多块，然后从大到小依次分给工作量最少的进程
+    :param items: 任务列表
+    :param key: 获取任务的分组
+    :param lanes: 工作进程数量
+    :param weight: 获取任务的工作量，为空时每个任务相同
+    :return: 任务到工作进程序号的映射
+    """
+    weights = {item: max(1, weight(item)) if weight else 1 for item in items}
+    groups: dict[Hashable, list[Path]] = defaultdict(list)
+    for item in items:
+        groups[key(item)].append(item)
+    share = math.ceil(sum(weights.values()) / lanes)
+    chunks: list[tuple[int, list[Path]]] = []
+    for group in groups.values():
+        chunk, total = [], 0
+        for item in group:
+            if chunk and total + weights[item] > share:
+                chunks.append((total, chunk))
+                chunk, total = [], 0
+            chunk.append(item)
+            total += weights[item]
+        if chunk:
+            chunks.append((total, chunk))
+    loads = [0] * lanes
+    result = {}
+    for total, chunk in sorted(chunks, key=lambda c: c[0], reverse=True):
+        lane = min(range(lanes), key=loads.__getitem__)
+        loads[lane] += total
+        for item in chunk:
+            result[item] = lane
+    return result
+
+
+class BatchSizer:
+    """
+    根据测得的每张照片的耗时调整批次大小，使每次进程间往返处理大约
+    TARGET_BATCH_SECONDS 的工作，分摊提交任务、序列化和回调的固定开销
+    """
+
+    def __init__(self, max_size: int = MAX_BATCH_SIZE):
+        """
+        :param max_size: 批次大小的上限，小于 MIN_BATCH_SIZE 时不合并
+        """
+        self.max_size = max(1, min(max_size, MAX_BATCH_SIZE))
+        self.size = min(INITIAL_BATCH_SIZE, self.max_size)
+        # 每张照片耗时的指数滑动平均
+        self.latency: float | None = None
+
+    def record(self, count: int, elapsed: float) -> None:
+        """
+        记录一个批次的耗时
+        :param count: 批次中的照片数量
+        :param elapsed: 工作进程处理这个批次的耗时（秒）
+        """
+        latency = elapsed / max(1, count)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.7 * self.latency + 0.3 * latency
+        size = round(TARGET_BATCH_SECONDS / max(self.latency, 1e-6))
+        # 每张照片的耗时已经超过目标时也至少合并两张，只有一张的批次只会增加开销
+        self.size = min(max(size, MIN_BATCH_SIZE), self.max_size)
+
+    @property
+    def enabled(self) -> bool:
+        return self.size >= MIN_BATCH_SIZE
+
+
+def iter_batches(
+    items: Iterable[Path],
+    is_small: Callable[[Path], bool],
+    sizer: BatchSizer,
+    key: Callable[[Path], Hashable] | None = None,
+) -> Iterator[Path | tuple[Path, ...]]:
+    """
+    把小图合并成批次，大图仍然单独作为一个任务。
+    批次在取用时才生成，大小使用 sizer 当时的测量结果；
+    不需要合并时，以及最后剩下的单张小图，仍然作为单独的任务
+    :param items: 任务列表
+    :param is_small: 是否是需要合并的小图
+    :param sizer: 批次大小
+    :param key: 只有 key 相同的小图才会合并到同一批次，例如分配给同一个工作进程
+    :return: 单张照片，或者多张小图组成的元组
+    """
+    buffers: dict[Hashable, list[Path]] = defaultdict(list)
+    for item in items:
+        if not sizer.enabled or not is_small(item):
+            yield item
+            continue
+        buffer = buffers[key(item) if key else None]
+        buffer.append(item)
+        if len(buffer) >= sizer.size:
+            yield tuple(buffer)
+            buffer.clear()
+    for buffer in buffers.values():
+        if len(buffer) > 1:
+            yield tuple(buffer)
+        elif buffer:
+            yield buffer[0]
+
+
+def get_rss() -> int | None:
+    """
+    获取当前进程的常驻内存
+    :return: 字节数，无法获取时返回 None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # 没有 /proc 时使用峰值内存代替，macOS 上的单位是字节，其他系统是 KB
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class WorkerExitedError(RuntimeError):
+    """
+    工作进程在执行任务时意外退出，例如被系统因内存不足杀死
+    """
+
+
+class RemoteTraceback(Exception):
+    """
+    工作进程中的调用栈，作为传回主进程的异常的 __cause__，记录日志时一起输出
+    """
+
+    def __init__(self, tb: str):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self) -> str:
+        return self.tb
+
+
+def _rebuild_exception(exc: BaseException, tb: str) -> BaseException:
+    exc.__cause__ = RemoteTraceback(tb)
+    return exc
+
+
+class _ExceptionWithTraceback:
+    # 异常被 pickle 时会丢失调用栈，与 ProcessPoolExecutor 一样以文本形式附带
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+        self.tb = "".join(traceback.format_exception(exc))
+
+    def __reduce__(self):
+        return _rebuild_exception, (self.exc, f'\n"""\n{self.tb}"""')
+
+
+def attach_traceback(exc: BaseException) -> Any:
+    """
+    包装工作进程中捕获的异常，传回主进程后仍然带有原来的调用栈
+    :param exc: 异常
+    :return: 可以 pickle 的对象，在主进程中恢复为原来的异常
+    """
+    return _ExceptionWithTraceback(exc)
+
+
+@dataclass(frozen=True)
+class RecycleEvent:
+    """
+    一次工作进程回收记录
+    """
+
+    pid: int
+    tasks: int
+    rss: int | None
+    reason: str
+
+
+@dataclass
+class RunReport:
+    """
+    一次批量处理的汇总信息
+    """
+
+    total: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    pool_stats: PoolStats = field(default_factory=PoolStats)
+    recycle_events: list[RecycleEvent] = field(default_factory=list)
+    # 按相机分组调度时的分组数，以及由其他工作进程代为执行的任务数
+    affinity_groups: int = 0
+    stolen_tasks: int = 0
+    # 以像素数作为耗时估算的总耗时：按文件顺序提交，以及按实际顺序提交
+    fifo_makespan: int = 0
+    planned_makespan: int = 0
+    # 最后一个任务提交后到全部完成的时间，即最慢的工作进程拖后的时间
+    tail: float = 0.0
+    # 小图合并成的批次数和其中的照片数
+    batches: int = 0
+    batched_items: int = 0
+
+    def log(self) -> None:
+        logger.info(
+            f"处理完成：共 {self.total} 张，失败 {self.failed} 张，"
+            f"耗时 {self.elapsed:.1f} 秒"
+        )
+        logger.info(
+            f"画布缓冲池命中率：{self.pool_stats.hit_rate:.1%}"
+            f"（命中 {self.pool_stats.hits} 次，未命中 {self.pool_stats.misses} 次）"
+        )
+        logger.info(f"最后一张照片提交后又用了 {self.tail:.1f} 秒完成")
+        if self.fifo_makespan and self.planned_makespan < self.fifo_makespan:
+            logger.info(
+                f"从大到小排序：按像素数估算，总耗时比按文件顺序提交缩短 "
+                f"{1 - self.planned_makespan / self.fifo_makespan:.1%}"
+            )
+        if self.batches:
+            logger.info(
+                f"小图合并提交：{self.batched_items} 张照片合并为 {self.batches} 批，"
+                f"平均每批 {self.batched_items / self.batches:.1f} 张"
+            )
+        if self.affinity_groups:
+            logger.info(
+                f"按相机分组调度：{self.affinity_groups} 个分组，"
+                f"{self.stolen_tasks} 张照片由其他工作进程代为处理"
+            )
+        for event in self.recycle_events:
+            rss = "未知" if event.rss is None else f"{event.rss / 2**20:.0f} MB"
+            logger.info(
+                f"回收工作进程 {event.pid}：{event.reason}，"
+                f"已完成 {event.tasks} 个任务，常驻内存 {rss}"
+            )
+
+
+def _worker_main(
+    tasks: Connection,
+    results: Connection,
+    initializer: Callable[..., None] | None,
+    initargs: tuple,
+    max_tasks: int | None,
+    max_rss: int | None,
+) -> None:
+    """
+    工作进程：逐个执行任务，每个任务完成后检查自身的内存，超过阈值时主动退出
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    done = 0
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args = task
+        try:
+            ok, value = True, fn(*args)
+        except Exception as e:
+            # 任意异常都属于这个任务，连同调用栈交给主进程，由提交任务的一方记录
+            ok, value = False, attach_traceback(e)
+        done += 1
+        rss = get_rss()
+        if max_rss is not None and rss is not None and rss > max_rss:
+            # 先释放缓冲池中的空闲画布，仍然超过上限时才退出
+            get_buffer_pool().clear()
+            rss = get_rss()
+        reason = None
+        if max_tasks is not None and done >= max_tasks:
+            reason = f"达到任务数上限 {max_tasks}"
+        elif max_rss is not None and rss is not None and rss > max_rss:
+            reason = f"常驻内存超过 {max_rss / 2**20:.0f} MB"
+        try:
+            results.send((ok, value, rss, reason))
+        except PICKLING_ERRORS as e:
+            # 结果无法序列化时只返回错误信息
+            results.send((False, RuntimeError(f"无法返回任务结果：{e!r}"), rss, reason))
+        if reason is not None:
+            return
+
+
+@dataclass(eq=False)
+class _Task:
+    future: Future
+    fn: Callable
+    args: tuple
+    # 任务的分组，同一分组的任务优先交给同一个工作进程
+    affinity: Hashable | None = None
+
+
+@dataclass(eq=False)
+class _Worker:
+    process: multiprocessing.process.BaseProcess
+    tasks: Connection
+    results: Connection
+    future: Future | None = None
+    done: int = 0
+    # 即将被回收，不再分配任务
+    retiring: bool = False
+
+
+class WorkerPool:
+    """
+    可以回收工作进程的进程池。工作进程每完成一个任务检查自身的常驻内存，
+    超过阈值或完成指定数量的任务后主动退出，进程池随即启动新的进程代替它，
+    新进程通过 initializer 预先加载字体、logo 等资源。
+    每个工作进程同时只执行一个任务，退出时不会丢失排队的任务。
+    提交任务时可以指定分组，同一分组的任务优先交给同一个工作进程，提高进程内缓存的命中率
+    """
+
+    def __init__(
+        self,
+        max_workers: int = MAX_WORKERS,
+        initializer: Callable[..., None] | None = None,
+        initargs: tuple = (),
+        max_tasks_per_worker: int | None = None,
+        max_worker_rss: int | None = None,
+    ):
+        """
+        :param max_workers: 工作进程数量
+        :param initializer: 工作进程启动时执行的函数
+        :param initargs: initializer 的参数
+        :param max_tasks_per_worker: 每个工作进程最多执行的任务数，为空时不限制
+        :param max_worker_rss: 工作进程常驻内存的上限（字节），为空时不限制
+        """
+        # 回收的进程在后台线程中重新启动，不能使用 fork
+        self._context = multiprocessing.get_context("spawn")
+        self._worker_args = (
+            initializer,
+            initargs,
+            max_tasks_per_worker,
+            max_worker_rss,
+        )
+        self._workers: list[_Worker] = []
+        self._pending: deque[_Task] = deque()
+        # 分组到工作进程序号的映射
+        self._homes: dict[Hashable, int] = {}
+        # 由其他工作进程代为执行的分组任务数
+        self.stolen_tasks = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self.recycle_events: list[RecycleEvent] = []
+        for _ in range(max_workers):
+            self._workers.append(self._spawn())
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _spawn(self) -> _Worker:
+        task_reader, task_writer = self._context.Pipe(duplex=False)
+        result_reader, result_writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(task_reader, result_writer, *self._worker_args),
+            daemon=True,
+        )
+        process.start()
+        # 子进程已经持有各自的一端，关闭主进程中的副本
+        task_reader.close()
+        result_writer.close()
+        return _Worker(process, task_writer, result_reader)
+
+    def submit(
+        self, fn: Callable, *args: Any, affinity: Hashable | None = None
+    ) -> Future:
+        """
+        提交任务，fn 和参数必须可以被 pickle
+        :param affinity: 任务的分组，为空时交给任意空闲的工作进程
+        :return: 任务对应的 Future
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("进程池已关闭")
+            if affinity is not None and affinity not in self._homes:
+                # 新的分组交给目前分组最少的工作进程
+                groups = Counter(self._homes.values())
+                self._homes[affinity] = min(
+                    range(len(self._workers)), key=groups.__getitem__
+                )
+            self._pending.append(_Task(future, fn, args, affinity))
+            self._dispatch()
+        return future
+
+    def _dispatch(self) -> None:
+        # 把排队的任务交给空闲的工作进程，调用时需要持有锁。
+        # 空闲的进程先执行归属于自己的任务，然后才接手排队较多的进程的分组
+        for steal in (False, True):
+            for index, worker in enumerate(self._workers):
+                while worker.future is None and not worker.retiring:
+                    task = self._take(index, steal)
+                    if task is None:
+                        break
+                    self._start(worker, task)
+
+    def _take(self, index: int, steal: bool) -> _Task | None:
+        homes = [self._homes.get(task.affinity) for task in self._pending]
+        if not steal:
+            for i, home in enumerate(homes):
+                if home is None or home == index:
+                    task = self._pending[i]
+                    del self._pending[i]
+                    return task
+            return None
+        # 从排队最多的进程的队尾取一个任务，它自己接下来要执行的任务不受影响
+        backlog = Counter(homes)
+        if not backlog:
+            return None
+        victim, count = backlog.most_common(1)[0]
+        if count < AFFINITY_STEAL_BACKLOG:
+            return None
+        i = len(homes) - 1 - homes[::-1].index(victim)
+        task = self._pending[i]
+        del self._pending[i]
+        self.stolen_tasks += 1
+        return task
+
+    def _start(self, worker: _Worker, task: _Task) -> None:
+        if not task.future.set_running_or_notify_cancel():
+            return
+        try:
+            worker.tasks.send((task.fn, task.args))
+        except PICKLING_ERRORS as e:
+            # 任务无法序列化，还没有写入管道，工作进程可以继续使用
+            task.future.set_exception(e)
+            return
+        except OSError as e:
+            # 工作进程已经退出，由收集线程回收
+            logger.warning(f"无法向工作进程 {worker.process.pid} 发送任务：{e}")
+            task.future.set_exception(
+                WorkerExitedError(f"工作进程 {worker.process.pid} 已经退出")
+            )
+            return
+        worker.future = task.future
+
+    def _collect(self) -> None:
+        # 后台线程：接收任务结果，回收退出的工作进程
+        while True:
+            with self._lock:
+                if self._shutdown and not any(w.future for w in self._workers):
+                    return
+                workers = list(self._workers)
+            waitables = {}
+            for worker in workers:
+                waitables[worker.results] = worker
+                waitables[worker.process.sentinel] = worker
+            for ready in wait_connections(list(waitables), timeout=0.1):
+                worker = waitables[ready]
+                with self._lock:
+                    if worker not in self._workers or worker.retiring:
+                        continue
+                    retired = self._handle(worker)
+                if retired is not None:
+                    self._recycle(worker, *retired)
+
+    def _handle(self, worker: _Worker) -> tuple[int | None, str] | None:
+        """
+        处理工作进程发来的结果或者进程退出，调用时需要持有锁
+        :return: 工作进程需要回收时返回 (常驻内存, 原因)
+        """
+        try:
+            ok, value, rss, reason = worker.results.recv()
+        except (EOFError, OSError):
+            if worker.process.is_alive():
+                return None
+            # 进程没有返回结果就退出了
+            if worker.future is not None:
+                worker.future.set_exception(
+                    WorkerExitedError(
+                        f"工作进程 {worker.process.pid} 意外退出，"
+                        f"退出码 {worker.process.exitcode}"
+                    )
+                )
+                worker.future = None
+            worker.retiring = True
+            return None, "进程意外退出"
+        future, worker.future = worker.future, None
+        worker.done += 1
+        if future is not None:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        if reason is not None:
+            worker.retiring = True
+        self._dispatch()
+        return None if reason is None else (rss, reason)
+
+    def _recycle(self, worker: _Worker, rss: int | None, reason: str) -> None:
+        # 在收集线程中、锁之外等待旧进程退出并启动新进程，期间可以继续提交任务，
+        # 其他工作进程的结果在新进程启动后处理
+        worker.process.join()
+        worker.tasks.close()
+        worker.results.close()
+        event = RecycleEvent(worker.process.pid, worker.done, rss, reason)
+        logger.debug(f"回收工作进程 {event.pid}：{reason}")
+        with self._lock:
+            shutdown = self._shutdown
+        replacement = None if shutdown else self._spawn()
+        with self._lock:
+            self.recycle_events.append(event)
+            index = self._workers.index(worker)
+            if replacement is None:
+                del self._workers[index]
+            else:
+                self._workers[index] = replacement
+            self._dispatch()
+
+    def shutdown(self) -> None:
+        """
+        等待正在执行的任务完成后关闭工作进程，还在排队的任务会被取消
+        """
+        with self._lock:
+            self._shutdown = True
+            pending = list(self._pending)
+            self._pending.clear()
+        for task in pending:
+            task.future.cancel()
+        self._collector.join()
+        for worker in self._workers:
+            try:
+                worker.tasks.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.tasks.close()
+            worker.results.close()
+        self._workers.clear()
+
+    def __enter__(self) -> WorkerPool:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
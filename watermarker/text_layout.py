@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Sequence
+
+from PIL import Image, ImageDraw
+
+from .buffer_pool import get_color
+from .config import load_font
+from .glyph_atlas import get_glyph_atlas
+from .utils import Align, Side, resize_image_with_height
+
+if TYPE_CHECKING:
+    from PIL.ImageFont import FreeTypeFont
+
+
+class Box:
+    """
+    布局元素：先通过字体度量计算尺寸，再直接绘制到画布上，不生成中间图片
+    """
+
+    width: int
+    height: int
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        """
+        将元素绘制到画布上
+        :param canvas: 画布
+        :param draw: 画布对应的 ImageDraw 对象
+        :param x: 左上角横坐标
+        :param y: 左上角纵坐标
+        """
+        raise NotImplementedError
+
+    def fit(self, height: int) -> Box:
+        """
+        按比例缩小到指定高度
+        """
+        raise NotImplementedError
+
+
+class TextBox(Box):
+    """
+    文字元素，尺寸与 text_to_image 生成的图片一致
+    """
+
+    def __init__(
+        self,
+        content: str,
+        font: FreeTypeFont,
+        bold_font: FreeTypeFont,
+        is_bold: bool = False,
+        fill: str = "black",
+        use_glyph_atlas: bool = False,
+    ):
+        self.content = content or "   "
+        self.regular_font = font
+        self.bold_font = bold_font
+        self.font = bold_font if is_bold else font
+        self.is_bold = is_bold
+        self.fill = fill
+        self.use_glyph_atlas = use_glyph_atlas
+        _, a, _, d = bold_font.getbbox("lgy", anchor="ls")
+        self.ascent = -a
+        self.height = d - a
+        _, _, self.width, _ = self.font.getbbox(self.content, anchor="ls")
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        fill = get_color(self.fill, canvas.mode)
+        if self.use_glyph_atlas:
+            atlas = get_glyph_atlas(self.font)
+            atlas.draw_text(draw, (x, y + self.ascent), self.content, fill)
+            return
+        draw.text(
+            (x, y + self.ascent),
+            self.content,
+            fill=fill,
+            font=self.font,
+            anchor="ls",
+        )
+
+    def fit(self, height: int) -> TextBox:
+        scale = height / self.height
+        # 通过缓存加载缩小后的字体，同样字号的元素共享字体和字形图集
+        font, bold_font = (
+            load_font(f.path, max(1, int(f.size * scale)))
+            for f in (self.regular_font, self.bold_font)
+        )
+        return TextBox(
+            self.content,
+            font,
+            bold_font,
+            self.is_bold,
+            self.fill,
+            self.use_glyph_atlas,
+        )
+
+
+class SpaceBox(Box):
+    """
+    空白元素
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        pass
+
+    def fit(self, height: int) -> SpaceBox:
+        return SpaceBox(max(1, round(self.width * height / self.height)), height)
+
+
+class RectBox(SpaceBox):
+    """
+    纯色矩形元素，例如分割线
+    """
+
+    def __init__(self, width: int, height: int, fill: str):
+        super().__init__(width, height)
+        self.fill = fill
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        fill = get_color(self.fill, canvas.mode)
+        canvas.paste(fill, (x, y, x + self.width, y + self.height))
+
+    def fit(self, height: int) -> RectBox:
+        width = max(1, round(self.width * height / self.height))
+        return RectBox(width, height, self.fill)
+
+
+class ImageBox(Box):
+    """
+    图片元素，例如 logo
+    """
+
+    def __init__(self, image: Image.Image):
+        self.image = image
+        self.width, self.height = image.size
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        mask = self.image if "A" in self.image.getbands() else None
+        canvas.paste(self.image, (x, y), mask=mask)
+
+    def fit(self, height: int) -> ImageBox:
+        return ImageBox(resize_image_with_height(self.image, height, auto_close=False))
+
+
+class ColumnBox(Box):
+    """
+    纵向排列的元素组
+    """
+
+    def __init__(self, children: Sequence[Box], align: Align = Align.START):
+        self.children = list(children)
+        self.align = align
+        self.width = max((child.width for child in self.children), default=0)
+        self.height = sum(child.height for child in self.children)
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        for child in self.children:
+            if self.align == Align.END:
+                x_offset = self.width - child.width
+            elif self.align == Align.START:
+                x_offset = 0
+            else:
+                x_offset = (self.width - child.width) // 2
+            child.draw(canvas, draw, x + x_offset, y)
+            y += child.height
+
+    def fit(self, height: int) -> ColumnBox:
+        scale = height / self.height
+        children = [
+            child.fit(max(1, round(child.height * scale))) for child in self.children
+        ]
+        return ColumnBox(children, self.align)
+
+
+class RowBox(Box):
+    """
+    横向排列的元素组
+    """
+
+    def __init__(self, children: Sequence[Box], align: Align = Align.CENTER):
+        self.children = list(children)
+        self.align = align
+        self.width = sum(child.width for child in self.children)
+        self.height = max((child.height for child in self.children), default=0)
+
+    def draw(self, canvas: Image.Image, draw: ImageDraw.ImageDraw, x: int, y: int):
+        for child in self.children:
+            if self.align == Align.END:
+                y_offset = self.height - child.height
+            elif self.align == Align.START:
+                y_offset = 0
+            else:
+                y_offset = (self.height - child.height) // 2
+            child.draw(canvas, draw, x, y + y_offset)
+            x += child.width
+
+    def fit(self, height: int) -> RowBox:
+        scale = height / self.height
+        children = [
+            child.fit(max(1, round(child.height * scale))) for child in self.children
+        ]
+        return RowBox(children, self.align)
+
+
+def draw_boxes_by_side(
+    canvas: Image.Image,
+    boxes: Sequence[Box | None],
+    side: Side = "left",
+    padding: tuple[int, int] = (200, 200),
+    gap: int = 200,
+    align: Align = Align.CENTER,
+) -> None:
+    """
+    将元素横向排列并绘制到画布中，排列方式与 append_image_by_side 一致
+    :param canvas: 画布
+    :param boxes: 元素列表
+    :param side: 排列方向，left/right
+    :param padding: 元素与画布边缘的间距
+    :param gap: 元素之间的间距
+    :param align: 对齐方式，center/end/start
+    """
+    px, py = padding
+    inner_height = canvas.height - 2 * py
+    boxes = [
+        box if box.height <= inner_height else box.fit(inner_height)
+        for box in boxes
+        if box is not None
+    ]
+    draw = ImageDraw.Draw(canvas)
+
+    def get_y_offset(box: Box) -> int:
+        if align == Align.START:
+            return py
+        elif align == Align.END:
+            return canvas.height - py - box.height
+        return (canvas.height - box.height) // 2
+
+    if side == "right":
+        x_offset = canvas.width - px
+        for box in reversed(boxes):
+            x_offset -= box.width
+            box.draw(canvas, draw, x_offset, get_y_offset(box))
+            x_offset -= gap
+    else:
+        x_offset = px
+        for box in boxes:
+            box.draw(canvas, draw, x_offset, get_y_offset(box))
+            x_offset += box.width + gap
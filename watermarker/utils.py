@@ -5,6 +5,7 @@ import logging
 import os
 import platform
 import re
+import struct
 import subprocess
 import sys
 from pathlib import Path
@@ -12,6 +13,7 @@ from typing import TYPE_CHECKING, Iterable, Literal, Sequence, Tuple, Union, ove
 
 from PIL import Image, ImageDraw, ImageOps
 
+from .buffer_pool import get_color, new_canvas
 from .constants import TRANSPARENT
 
 if TYPE_CHECKING:
@@ -45,6 +47,11 @@ if platform.system() == "Windows":
 else:
     EXIFTOOL_PATH = Path(BASE_PATH, "exiftool/exiftool")
 
+EXIFTOOL_DATE_FORMAT = "%Y-%m-%d %H:%M:%S%3f%z"
+# 批量读取时 exiftool 在每张照片的输出前打印一行 "======== 文件名"
+EXIFTOOL_SEPARATOR = "======== "
+EXIFTOOL_BATCH_SIZE = 64
+
 
 class Align(enum.IntEnum):
     CENTER = 0
@@ -60,6 +67,9 @@ class Axis(enum.IntEnum):
 logger = logging.getLogger(__name__)
 
 
+JPEG_SUFFIXES = (".jpg", ".jpeg")
+
+
 def get_file_list(path: str) -> list[Path]:
     """
     获取 jpg 文件列表
@@ -86,36 +96,80 @@ def get_exif(path: str | Path) -> dict[str, str]:
     exif_dict = {}
     try:
         output_bytes = subprocess.check_output(
-            [EXIFTOOL_PATH, "-d", "%Y-%m-%d %H:%M:%S%3f%z", str(path)]
+            [EXIFTOOL_PATH, "-d", EXIFTOOL_DATE_FORMAT, str(path)]
         )
         output = output_bytes.decode("utf-8", errors="ignore")
-
-        lines = output.splitlines()
-        utf8_lines = [line for line in lines]
-
-        for line in utf8_lines:
-            # 将每一行按冒号分隔成键值对
-            kv_pair = line.split(":", 1)
-            if len(kv_pair) < 2:
-                continue
-            key = kv_pair[0].strip()
-            value = kv_pair[1].strip()
-            # 将键中的空格移除
-            key = re.sub(r"\s+", "", key)
-            key = re.sub(r"/", "", key)
-            # 将键值对添加到字典中
-            exif_dict[key] = value
-        for key, value in exif_dict.items():
-            # 过滤非 ASCII 字符
-            value_clean = "".join(c for c in value if ord(c) < 128)
-            # 将处理后的值更新到 exif_dict 中
-            exif_dict[key] = value_clean
+        exif_dict = parse_exif_lines(output.splitlines())
     except Exception as e:
         logger.error(f"get_exif error: {path} : {e}")
 
     return exif_dict
 
 
+def parse_exif_lines(lines: Iterable[str]) -> dict[str, str]:
+    """
+    解析 exiftool 输出的 "键 : 值" 行
+    :param lines: 输出的每一行
+    :return: exif信息
+    """
+    exif_dict = {}
+    for line in lines:
+        # 将每一行按冒号分隔成键值对
+        kv_pair = line.split(":", 1)
+        if len(kv_pair) < 2:
+            continue
+        key = kv_pair[0].strip()
+        value = kv_pair[1].strip()
+        # 将键中的空格移除
+        key = re.sub(r"\s+", "", key)
+        key = re.sub(r"/", "", key)
+        # 将键值对添加到字典中
+        exif_dict[key] = value
+    for key, value in exif_dict.items():
+        # 过滤非 ASCII 字符
+        value_clean = "".join(c for c in value if ord(c) < 128)
+        # 将处理后的值更新到 exif_dict 中
+        exif_dict[key] = value_clean
+    return exif_dict
+
+
+def get_exif_batch(paths: Sequence[Path]) -> dict[Path, dict[str, str]]:
+    """
+    批量获取多张照片的exif信息，每 EXIFTOOL_BATCH_SIZE 张照片只启动一次 exiftool
+    :param paths: 照片路径列表
+    :return: 照片路径到exif信息的映射，读取失败的照片不包含在结果中
+    """
+    result = {}
+    for start in range(0, len(paths), EXIFTOOL_BATCH_SIZE):
+        batch = paths[start : start + EXIFTOOL_BATCH_SIZE]
+        try:
+            # 部分照片读取失败时 exiftool 返回非零值，其他照片的输出仍然有效
+            output = subprocess.run(
+                [EXIFTOOL_PATH, "-d", EXIFTOOL_DATE_FORMAT, *map(str, batch)],
+                stdout=subprocess.PIPE,
+            ).stdout.decode("utf-8", errors="ignore")
+        except Exception as e:
+            logger.error(f"get_exif error: {batch[0]} 等 {len(batch)} 张照片 : {e}")
+            continue
+        if len(batch) == 1:
+            # 只有一张照片时 exiftool 不输出文件名分隔行
+            result[batch[0]] = parse_exif_lines(output.splitlines())
+            continue
+        # Windows 上 exiftool 输出的文件名使用正斜杠，统一转换为 Path 比较
+        paths_by_name = {Path(path): path for path in batch}
+        path, lines = None, []
+        for line in [*output.splitlines(), EXIFTOOL_SEPARATOR]:
+            if line.startswith(EXIFTOOL_SEPARATOR):
+                if path is not None:
+                    result[path] = parse_exif_lines(lines)
+                name = line[len(EXIFTOOL_SEPARATOR) :].strip()
+                path = paths_by_name.get(Path(name))
+                lines = []
+            else:
+                lines.append(line)
+    return result
+
+
 def insert_exif(source_path: Path, target_path: Path) -> None:
     """
     复制照片的 exif 信息
@@ -187,7 +241,7 @@ def padding_image(
     color: Color = TRANSPARENT,
 ) -> Image.Image | None:
     """
-    在图片四周填充白色像素
+    在图片四周填充白色像素，填充后的图片与原图模式相同
     :param image: 图片对象
     :param padding_size: 填充像素大小
     :param padding_location: 填充位置，top/bottom/left/right
@@ -196,7 +250,23 @@ def padding_image(
     if image is None:
         return None
 
-    total_width, total_height = image.size
+    size, offset = get_padding_geometry(image.size, padding_size, padding_location)
+    padding_img = new_canvas(image.mode, size, color=color)
+    padding_img.paste(image, offset)
+    return padding_img
+
+
+def get_padding_geometry(
+    size: tuple[int, int], padding_size: int, padding_location: str = "tb"
+) -> tuple[tuple[int, int], tuple[int, int]]:
+    """
+    计算 padding_image 填充后的尺寸，以及原图在填充后图片中的位置
+    :param size: 原图尺寸
+    :param padding_size: 填充像素大小
+    :param padding_location: 填充位置，top/bottom/left/right
+    :return: (填充后的尺寸, 原图的位置)
+    """
+    total_width, total_height = size
     x_offset, y_offset = 0, 0
     if "t" in padding_location:
         total_height += padding_size
@@ -208,10 +278,7 @@ def padding_image(
         x_offset += padding_size
     if "r" in padding_location:
         total_width += padding_size
-
-    padding_img = Image.new("RGBA", (total_width, total_height), color=color)
-    padding_img.paste(image, (x_offset, y_offset))
-    return padding_img
+    return (total_width, total_height), (x_offset, y_offset)
 
 
 def square_image(image: Image.Image, auto_close: bool = True) -> Image.Image:
@@ -230,7 +297,7 @@ def square_image(image: Image.Image, auto_close: bool = True) -> Image.Image:
     delta_w = abs(width - height)
     padding = (delta_w // 2, 0) if width < height else (0, delta_w // 2)
 
-    square_img = ImageOps.expand(image, padding, fill="white")
+    square_img = ImageOps.expand(image, padding, fill=get_color("white", image.mode))
 
     if auto_close:
         image.close()
@@ -239,6 +306,173 @@ def square_image(image: Image.Image, auto_close: bool = True) -> Image.Image:
     return square_img
 
 
+def nine_slice(
+    image: Image.Image,
+    size: tuple[int, int],
+    canvas: Image.Image | None = None,
+    offset: tuple[int, int] = (0, 0),
+) -> Image.Image:
+    """
+    九宫格拉伸：四个角保持不变，四条边沿长度方向拉伸，中间用中心像素填充
+    :param image: 九宫格图片，四个角各占图片的四分之一，边缘沿长度方向不变
+    :param size: 目标尺寸，不能小于九宫格图片
+    :param canvas: 绘制到的画布，为空时创建新的图片
+    :param offset: 在画布中的位置
+    :return: 拉伸后的图片对象
+    """
+    width, height = size
+    x, y = offset
+    bw, bh = image.width // 2, image.height // 2
+    # 右侧和下侧的角在目标图片中的位置
+    right, bottom = width - image.width + bw, height - image.height + bh
+    center = image.getpixel((bw, bh))
+    if canvas is None:
+        canvas = new_canvas(image.mode, size, color=center)
+    else:
+        canvas.paste(center, (x, y, x + width, y + height))
+
+    # 四个角
+    for box, (cx, cy) in (
+        ((0, 0, bw, bh), (0, 0)),
+        ((bw, 0, image.width, bh), (right, 0)),
+        ((0, bh, bw, image.height), (0, bottom)),
+        ((bw, bh, image.width, image.height), (right, bottom)),
+    ):
+        with image.crop(box) as corner:
+            canvas.paste(corner, (x + cx, y + cy))
+
+    # 四条边，取中间的一行或一列像素拉伸
+    inner_width, inner_height = right - bw, bottom - bh
+    if inner_width > 0:
+        for box, (cx, cy) in (
+            ((bw, 0, bw + 1, bh), (bw, 0)),
+            ((bw, bh, bw + 1, image.height), (bw, bottom)),
+        ):
+            with image.crop(box) as strip:
+                strip_size = (inner_width, strip.height)
+                canvas.paste(strip.resize(strip_size, Image.NEAREST), (x + cx, y + cy))
+    if inner_height > 0:
+        for box, (cx, cy) in (
+            ((0, bh, bw, bh + 1), (0, bh)),
+            ((bw, bh, image.width, bh + 1), (right, bh)),
+        ):
+            with image.crop(box) as strip:
+                strip_size = (strip.width, inner_height)
+                canvas.paste(strip.resize(strip_size, Image.NEAREST), (x + cx, y + cy))
+    return canvas
+
+
+def fill_border(
+    canvas: Image.Image,
+    box: tuple[int, int, int, int],
+    inner_box: tuple[int, int, int, int],
+    color: Color,
+) -> None:
+    """
+    填充 box 中除 inner_box 以外的区域
+    :param canvas: 画布
+    :param box: 外部区域
+    :param inner_box: 内部区域，不会被填充
+    :param color: 填充颜色
+    """
+    left, top, right, bottom = box
+    inner_left, inner_top, inner_right, inner_bottom = inner_box
+    for region in (
+        (left, top, right, inner_top),
+        (left, inner_bottom, right, bottom),
+        (left, inner_top, inner_left, inner_bottom),
+        (inner_right, inner_top, right, inner_bottom),
+    ):
+        if region[0] < region[2] and region[1] < region[3]:
+            canvas.paste(get_color(color, canvas.mode), region)
+
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def set_exif_orientation(exif: bytes, orientation: int = 1) -> bytes:
+    """
+    修改原始 EXIF 数据中的方向标签，其余内容原样保留
+    :param exif: 原始 EXIF 数据，可以带有 JPEG 的 Exif 前缀
+    :param orientation: 新的方向值
+    :return: 修改后的 EXIF 数据，没有方向标签时原样返回
+    """
+    start = 6 if exif.startswith(b"Exif\x00\x00") else 0
+    byte_order = exif[start : start + 2]
+    if byte_order == b"II":
+        prefix = "<"
+    elif byte_order == b"MM":
+        prefix = ">"
+    else:
+        return exif
+    try:
+        (ifd_offset,) = struct.unpack_from(prefix + "I", exif, start + 4)
+        position = start + ifd_offset
+        (count,) = struct.unpack_from(prefix + "H", exif, position)
+        for i in range(count):
+            entry = position + 2 + i * 12
+            tag, value_type = struct.unpack_from(prefix + "HH", exif, entry)
+            # 方向标签为 SHORT 类型，值直接存放在条目中
+            if tag == EXIF_ORIENTATION_TAG and value_type == 3:
+                data = bytearray(exif)
+                struct.pack_into(prefix + "H", data, entry + 8, orientation)
+                return bytes(data)
+    except struct.error:
+        pass
+    return exif
+
+
+# 处理器可以直接绘制的图片模式，其他模式在打开时转换
+WORKING_MODES = ("RGB", "RGBA", "L", "LA", "CMYK")
+
+
+def to_working_mode(image: Image.Image) -> Image.Image:
+    """
+    将刚打开的图片转换为处理器可以绘制的模式，透明通道、灰度和 CMYK 保持不变。
+    Pillow 无法在 16 位图片上绘制和模糊，16 位灰度图片按高 8 位转换为 L
+    :param image: 尚未解码的图片对象
+    :return: 模式已在 WORKING_MODES 中的图片对象，无需转换时返回原对象
+    """
+    mode = image.mode
+    if mode in WORKING_MODES:
+        return image
+    if mode in ("P", "PA"):
+        has_alpha = mode == "PA" or "transparency" in image.info
+        converted = image.convert("RGBA" if has_alpha else "RGB")
+    elif mode.startswith("I;16") or mode == "I":
+        converted = image.convert("I").point(lambda v: v / 256).convert("L")
+    elif len(image.getbands()) == 1:
+        converted = image.convert("L")
+    else:
+        converted = image.convert("RGB")
+    image.close()
+    return converted
+
+
+def shrink_image(image: Image.Image, max_size: int) -> Image.Image:
+    """
+    按照最大边长缩小刚打开的图片，
+    JPEG 图片使用 draft 模式直接以 1/2、1/4、1/8 的尺寸解码
+    :param image: 尚未解码的图片对象
+    :param max_size: 最大边长
+    :return: 缩小后的图片对象
+    """
+    width, height = image.size
+    scale = max_size / max(width, height)
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    # draft 会选择不小于目标尺寸的最大缩放比例，剩余部分再用 LANCZOS 缩放
+    if image.format == "JPEG":
+        image.draft(image.mode, size)
+    if image.size == size:
+        return image
+    resized_image = image.resize(size, Image.LANCZOS)
+    image.close()
+    return resized_image
+
+
 def resize_image_with_height(
     image: Image.Image, height: int, auto_close: bool = True
 ) -> Image.Image:
@@ -347,6 +581,14 @@ def append_image_by_side(
             x_offset += gap
 
 
+def get_text_height(bold_font: FreeTypeFont) -> int:
+    """
+    获取 text_to_image 生成的文字图片高度，只计算字体度量，不绘制文字
+    """
+    _, a, _, d = bold_font.getbbox("lgy", anchor="ls")
+    return d - a
+
+
 def text_to_image(
     content: str,
     font: FreeTypeFont,